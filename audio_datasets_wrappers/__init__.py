@@ -0,0 +1,39 @@
+import importlib
+
+# public names are resolved on first access, so importing the package does not pull in
+# torch, torchaudio or pytorch_lightning before they are needed
+_EXPORTS = {
+    'PhonemeData': 'dataset',
+    'PhonemeFrames': 'dataset',
+    'PhonemeLabeler': 'utils',
+    'PhonemeDataset': 'dataset',
+    'LazyPhonemeDataset': 'dataset',
+    'PackedPhonemeDataset': 'dataset',
+    'BucketBatchSampler': 'dataset',
+    'PaddedCollate': 'dataset',
+    'StreamingPhonemeDataset': 'streaming',
+    'ShardedPhonemeDataset': 'shards',
+    'save_shards': 'shards',
+    'FeatureDataset': 'features',
+    'cache_features': 'features',
+    'PhonemeDataModule': 'datamodule',
+    'PipelineMetrics': 'metrics',
+    'SharedAudioCache': 'cache',
+    'create_timit_discription_table': 'utils',
+    'create_arctic_discription_table': 'utils',
+    'create_librispeech_description_table': 'utils',
+    'compact_description_table': 'utils',
+    'get_audio_data': 'extraction',
+    'save_audio_data': 'extraction'
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module(f'.{_EXPORTS[name]}', __name__), name)
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + __all__)
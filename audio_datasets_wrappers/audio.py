@@ -0,0 +1,96 @@
+import io
+import functools
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from pathlib import Path
+
+from .cache import SharedAudioCache
+from .metrics import PipelineMetrics, measure
+
+# torchaudio normalizes 16-bit PCM by this scale, so the conversions below are exact
+PCM_SCALE = 32768
+
+
+def get_frame_count(
+        segment_length: int | np.ndarray,
+        frame_length: int,
+        hop_length: int | None = None
+    ) -> int | np.ndarray:
+    hop_length = frame_length // 2 if hop_length is None else hop_length
+    # the number of full frames that fit into the segment plus one zero-padded tail frame
+    return np.maximum((segment_length - frame_length) // hop_length + 1, 0) + 1
+
+def frame_audio(data: torch.Tensor, frame_length: int, hop_length: int | None = None) -> torch.Tensor:
+    # (channels, length) -> (n_frames, channels, frame_length), the tail frame is padded with zeros
+    hop_length = frame_length // 2 if hop_length is None else hop_length
+    frame_count = int(get_frame_count(data.shape[-1], frame_length, hop_length))
+    data = F.pad(data, (0, (frame_count - 1) * hop_length + frame_length - data.shape[-1]), 'constant', 0.0)
+    return data.unfold(-1, frame_length, hop_length).transpose(0, 1)
+
+def load_audio(
+        file_path: str | Path,
+        audio_file: bytes | None = None,
+        audio_cache: SharedAudioCache | None = None,
+        metrics: PipelineMetrics | None = None
+    ) -> tuple[torch.Tensor, int, int]:
+    # the samples, frame rate and sample width of a whole file; a file that was read ahead is
+    # decoded from memory and a file held by the shared cache is not decoded at all
+    import torchaudio
+
+    if audio_cache is not None:
+        cached = audio_cache.get(str(file_path))
+        if cached is not None:
+            return cached
+
+    def get_source() -> Path | io.BytesIO:
+        return Path(file_path) if audio_file is None else io.BytesIO(audio_file)
+
+    with measure(metrics, 'probe'):
+        metadata = torchaudio.info(get_source())
+    with measure(metrics, 'decode'):
+        data, _ = torchaudio.load(get_source())
+    if metrics is not None:
+        metrics.increment('files_read')
+        metrics.increment('bytes_read', Path(file_path).stat().st_size if audio_file is None else len(audio_file))
+
+    if audio_cache is not None:
+        audio_cache.put(str(file_path), data, int(metadata.sample_rate), metadata.bits_per_sample)
+    return data, int(metadata.sample_rate), metadata.bits_per_sample
+
+def check_pcm16(path: str | Path, sample_width: int) -> None:
+    # compressed formats report a sample width of 0
+    if not 0 < sample_width <= 16:
+        raise ValueError(f'{path} has {sample_width}-bit samples, int16 storage is exact only for PCM up to 16 bits')
+
+def float_to_pcm(data: torch.Tensor) -> torch.Tensor:
+    return (data * PCM_SCALE).round().clamp(-PCM_SCALE, PCM_SCALE - 1).to(torch.int16)
+
+def pcm_to_float(data: torch.Tensor) -> torch.Tensor:
+    # float samples pass through, so it is safe to apply to any batch
+    if data.dtype != torch.int16:
+        return data
+    return data.to(torch.float32) / PCM_SCALE
+
+@functools.lru_cache(maxsize=None)
+def get_resampler(orig_frame_rate: int, new_frame_rate: int) -> torch.nn.Module:
+    # the windowed sinc kernel is computed once per pair of rates and reused for every file
+    import torchaudio
+
+    return torchaudio.transforms.Resample(orig_frame_rate, new_frame_rate)
+
+def normalize_audio(
+        data: torch.Tensor,
+        frame_rate: int,
+        target_frame_rate: int | None = None,
+        mono: bool = False
+    ) -> tuple[torch.Tensor, int]:
+    # downmixes and resamples a whole (channels, length) file in one call
+    if mono and data.shape[0] > 1:
+        data = data.mean(dim=0, keepdim=True)
+    if target_frame_rate is not None and target_frame_rate != frame_rate:
+        with torch.no_grad():
+            data = get_resampler(frame_rate, target_frame_rate)(data)
+        frame_rate = target_frame_rate
+    return data, frame_rate
@@ -0,0 +1,169 @@
+import os
+import time
+import hashlib
+import numpy as np
+import torch
+
+from pathlib import Path
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from typing import Iterator
+
+from .shared import create_shared_dir, check_process
+
+STATS_FIELDS = ['hits', 'misses', 'evictions', 'size']
+
+class SharedAudioCache:
+    def __init__(
+            self,
+            max_size: int = 2 ** 30,
+            cache_dir: str | None = None,
+            flush_interval: float = 1.0,
+            touch_interval: float = 1.0,
+            num_mapped: int = 16
+        ) -> None:
+        # decoded files are kept in a tmpfs directory, so the cache is shared by every process that
+        # receives this object, DataLoader and extraction workers included, and pickles by path
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.touch_interval = touch_interval
+        self.num_mapped = num_mapped
+        if cache_dir is None:
+            cache_dir, self._finalizer = create_shared_dir(self, 'audio-cache-')
+        self.cache_dir = cache_dir
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with self._lock():
+            if not Path(cache_dir, 'stats.npy').exists():
+                np.save(Path(cache_dir, 'stats.npy'), np.zeros(len(STATS_FIELDS), dtype=np.int64))
+        self._reset_process_state()
+
+    def __getstate__(self) -> dict:
+        # only the process that created the directory removes it
+        state = self.__dict__.copy()
+        state.pop('_finalizer', None)
+        return state
+
+    def _reset_process_state(self) -> None:
+        # hit and miss counts, the last mapped entries and access times are kept per process and
+        # the counts are added to the shared stats every flush_interval seconds; a mapped entry
+        # stays readable after its eviction until it leaves the num_mapped most recent ones
+        self._pid = os.getpid()
+        self._pending = Counter()
+        self._last_flush = time.monotonic()
+        self._mapped = OrderedDict()
+        self._touched = dict()
+
+    def _check_process(self) -> None:
+        # a forked copy starts without the pending counts of its parent and adds its own at exit
+        check_process(self, self._pid, self._reset_process_state, self.flush)
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        import fcntl
+
+        with open(Path(self.cache_dir, 'lock'), mode='a') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    def _update_stats(self, **deltas: int) -> None:
+        with self._lock():
+            stats = np.load(Path(self.cache_dir, 'stats.npy'), mmap_mode='r+')
+            for name, delta in deltas.items():
+                stats[STATS_FIELDS.index(name)] += delta
+            stats.flush()
+
+    def _count(self, name: str) -> None:
+        self._pending[name] += 1
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        self._check_process()
+        if self._pending:
+            self._update_stats(**self._pending)
+            self._pending.clear()
+        self._last_flush = time.monotonic()
+
+    @property
+    def stats(self) -> dict[str, int]:
+        self.flush()
+        stats = np.load(Path(self.cache_dir, 'stats.npy'))
+        return {name: int(value) for name, value in zip(STATS_FIELDS, stats)}
+
+    def _get_path(self, key: str) -> Path:
+        return Path(self.cache_dir, f'{hashlib.sha1(key.encode()).hexdigest()}.npy')
+
+    def get(self, key: str) -> tuple[torch.Tensor, int, int] | None:
+        # the samples are memory-mapped, callers slicing a part of a file only read its pages
+        self._check_process()
+        if key in self._mapped:
+            self._mapped.move_to_end(key)
+        else:
+            path = self._get_path(key)
+            try:
+                data = torch.from_numpy(np.load(path, mmap_mode='c'))
+                frame_rate, sample_width = np.loadtxt(path.with_suffix('.info'), dtype=np.int64)
+            except FileNotFoundError:
+                self._count('misses')
+                return None
+            self._mapped[key] = data, int(frame_rate), int(sample_width)
+            if len(self._mapped) > self.num_mapped:
+                self._mapped.popitem(last=False)
+        now = time.monotonic()
+        if now - self._touched.get(key, -np.inf) >= self.touch_interval:
+            # the modification time orders the entries for eviction, it is refreshed at most
+            # once per touch_interval by every process
+            self._touched[key] = now
+            try:
+                os.utime(self._get_path(key))
+            except FileNotFoundError:
+                pass
+        self._count('hits')
+        return self._mapped[key]
+
+    def put(self, key: str, data: torch.Tensor, frame_rate: int, sample_width: int) -> None:
+        self._check_process()
+        path = self._get_path(key)
+        size = data.numel() * data.element_size()
+        if size > self.max_size:
+            return
+        temporary_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(temporary_path, mode='wb') as file:
+            np.save(file, data.contiguous().numpy())
+        entry_size = temporary_path.stat().st_size
+
+        with self._lock():
+            if path.exists():
+                # another worker cached the same file meanwhile
+                temporary_path.unlink()
+                return
+            # the format is written before the samples appear and removed after they are gone
+            np.savetxt(path.with_suffix('.info'), [frame_rate, sample_width], fmt='%d')
+            os.replace(temporary_path, path)
+            stats = np.load(Path(self.cache_dir, 'stats.npy'), mmap_mode='r+')
+            stats[STATS_FIELDS.index('size')] += entry_size
+            if stats[STATS_FIELDS.index('size')] > self.max_size:
+                # least recently used entries go first, readers that already mapped them keep their pages
+                entries = sorted(Path(self.cache_dir).glob('*.npy'), key=lambda entry: entry.stat().st_mtime_ns)
+                for entry in entries:
+                    if stats[STATS_FIELDS.index('size')] <= self.max_size:
+                        break
+                    if entry.name == 'stats.npy':
+                        continue
+                    stats[STATS_FIELDS.index('size')] -= entry.stat().st_size
+                    stats[STATS_FIELDS.index('evictions')] += 1
+                    entry.unlink()
+                    entry.with_suffix('.info').unlink(missing_ok=True)
+            stats.flush()
+
+    def clear(self) -> None:
+        with self._lock():
+            for entry in Path(self.cache_dir).glob('*.npy'):
+                if entry.name != 'stats.npy':
+                    entry.unlink()
+                    entry.with_suffix('.info').unlink(missing_ok=True)
+            np.save(Path(self.cache_dir, 'stats.npy'), np.zeros(len(STATS_FIELDS), dtype=np.int64))
+        self._reset_process_state()
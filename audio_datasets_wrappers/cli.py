@@ -0,0 +1,148 @@
+import json
+import time
+import shutil
+import argparse
+
+from pathlib import Path
+
+from .metrics import PipelineMetrics
+
+BUILDERS = {
+    'timit': 'create_timit_discription_table',
+    'arctic': 'create_arctic_discription_table',
+    'librispeech': 'create_librispeech_description_table'
+}
+
+
+def _parse_args(argv: list[str] | None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='audio-datasets-prepare',
+        description='Builds the description table of a corpus and extracts its phoneme frames into a packed store'
+    )
+    parser.add_argument('corpus', choices=list(BUILDERS))
+    parser.add_argument('dir_path', help='root directory of the corpus')
+    parser.add_argument('output_dir', help='where desc_table.pkl, the frames store or shards and summary.json are written')
+    parser.add_argument('--labels', required=True, help='JSON file mapping every phoneme class to its phonemes')
+    parser.add_argument('--num-workers', type=int, default=0, help='processes for parsing and extraction')
+    parser.add_argument('--read-ahead', type=int, default=0, help='audio files read ahead by threads of every extraction process')
+    parser.add_argument('--cache-dir', default=None, help='cache of parsed tables reused by later runs')
+    parser.add_argument('--compact', action='store_true', help='store repeated strings of the table as categoricals')
+    parser.add_argument('--no-overlap', action='store_true', help='keep every phoneme as one unframed segment')
+    parser.add_argument('--frame-length', type=int, default=1024)
+    parser.add_argument('--hop-length', type=int, default=None)
+    parser.add_argument('--padding-length', type=int, default=None, help='pad every segment to this length instead of framing')
+    parser.add_argument('--target-frame-rate', type=int, default=None)
+    parser.add_argument('--mono', action='store_true')
+    parser.add_argument('--int16', action='store_true', help='store 16-bit PCM frames as int16 instead of float32')
+    parser.add_argument('--table-only', action='store_true', help='build the description table without extracting frames')
+    parser.add_argument('--max-shard-size-mb', type=int, default=None, help='write shuffled shards of this size instead of one store')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the frame order across shards')
+    return parser.parse_args(argv)
+
+def _print_summary(summary: dict) -> None:
+    metrics = summary['metrics']
+    print(f"rows: {summary['rows']}, files: {summary['files']}, frames: {summary.get('frames', 0)}")
+    print(f"table: {summary['table_seconds']:.2f} s")
+    if 'extraction_seconds' in summary:
+        seconds = max(summary['extraction_seconds'], 1e-9)
+        print(
+            f"extraction: {summary['extraction_seconds']:.2f} s, "
+            f"{summary['rows'] / seconds:.1f} segments/s, "
+            f"{summary['frames'] / seconds:.1f} frames/s, "
+            f"{metrics.get('bytes_read', 0) / 2 ** 20 / seconds:.1f} MB/s read"
+        )
+    for stage in ['scan', 'parse', 'read_wait', 'probe', 'decode', 'normalize', 'slice', 'frame', 'pad']:
+        if f'{stage}/count' in metrics:
+            print(
+                f"  {stage}: {metrics[f'{stage}/total_s']:.2f} s over {int(metrics[f'{stage}/count'])} calls, "
+                f"p50 {metrics[f'{stage}/p50_ms']:.2f} ms, p99 {metrics[f'{stage}/p99_ms']:.2f} ms"
+            )
+
+def main(argv: list[str] | None = None) -> None:
+    args = _parse_args(argv)
+
+    # the description table is built without torch, it is imported for extraction only
+    from . import utils
+    from .utils import PhonemeLabeler
+
+    with open(args.labels, mode='r') as file:
+        phoneme_labeler = PhonemeLabeler(json.load(file))
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    # stage timings of worker processes are merged into the same metrics, so with several
+    # workers their sum exceeds the wall time
+    metrics = PipelineMetrics()
+
+    start = time.perf_counter()
+    desc_table = getattr(utils, BUILDERS[args.corpus])(
+        args.dir_path,
+        phoneme_labeler,
+        num_workers=args.num_workers,
+        cache_dir=args.cache_dir,
+        compact=args.compact,
+        metrics=metrics
+    )
+    desc_table.to_pickle(Path(output_dir, 'desc_table.pkl'))
+    summary = dict(
+        corpus=args.corpus,
+        dir_path=str(Path(args.dir_path).resolve()),
+        rows=int(desc_table.shape[0]),
+        files=int(desc_table.audio_file_path.nunique()),
+        table_seconds=time.perf_counter() - start
+    )
+
+    if not args.table_only:
+        from .extraction import get_audio_data, save_audio_data
+
+        start = time.perf_counter()
+        audio_data = get_audio_data(
+            desc_table,
+            args.dir_path,
+            overlapping_frames=not args.no_overlap,
+            frame_length=args.frame_length,
+            hop_length=args.hop_length,
+            padding_length=args.padding_length,
+            num_workers=args.num_workers,
+            columnar=True,
+            target_frame_rate=args.target_frame_rate,
+            mono=args.mono,
+            metrics=metrics,
+            read_ahead=args.read_ahead,
+            int16=args.int16
+        )
+        if args.max_shard_size_mb is not None:
+            from .shards import save_shards
+
+            summary['shards'] = len(save_shards(
+                audio_data,
+                Path(output_dir, 'shards'),
+                max_shard_size=args.max_shard_size_mb * 2 ** 20,
+                seed=args.seed
+            ))
+        else:
+            # the store is renamed into place only once it is complete
+            store_path, temporary_path = Path(output_dir, 'frames'), Path(output_dir, 'frames.tmp')
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            save_audio_data(audio_data, temporary_path)
+            shutil.rmtree(store_path, ignore_errors=True)
+            temporary_path.rename(store_path)
+        summary.update(
+            frames=len(audio_data),
+            extraction_seconds=time.perf_counter() - start,
+            overlapping_frames=not args.no_overlap,
+            frame_length=args.frame_length,
+            hop_length=args.hop_length,
+            padding_length=args.padding_length,
+            target_frame_rate=args.target_frame_rate,
+            mono=args.mono,
+            int16=args.int16
+        )
+
+    summary['metrics'] = metrics.summary()
+    with open(Path(output_dir, 'summary.json'), mode='w') as file:
+        json.dump(summary, file, indent=4)
+    _print_summary(summary)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,22 @@
+import os
+import shutil
+import socket
 import torch
+import numpy as np
 import pandas as pd
 import pytorch_lightning as pl
 
-from dataset import PhonemeDataset
-from utils import get_audio_data
+from .dataset import PhonemeDataset, LazyPhonemeDataset, PackedPhonemeDataset, BucketBatchSampler, PaddedCollate
+from .extraction import get_audio_data, save_audio_data
+from .streaming import StreamingPhonemeDataset
+from .features import FeatureDataset, cache_features, get_dataset_fingerprint
+from .metrics import PipelineMetrics, measure
+from .cache import SharedAudioCache
+from .audio import pcm_to_float
 from torch.utils.data import DataLoader
-from sklearn.model_selection import train_test_split
+
+from pathlib import Path
+from typing import Any
 
 
 class PhonemeDataModule(pl.LightningDataModule):
@@ -18,7 +29,29 @@ class PhonemeDataModule(pl.LightningDataModule):
             fraction: float = 0.5,
             transform: torch.nn.Module | torch.nn.Sequential | None = None,
             overlapping: bool = True,
-            frame_length: int = 1024
+            frame_length: int = 1024,
+            hop_length: int | None = None,
+            target_frame_rate: int | None = None,
+            mono: bool = False,
+            num_workers: int = 0,
+            lazy: bool = False,
+            streaming: bool = False,
+            shuffle_buffer_size: int = 10000,
+            feature_cache_dir: str | None = None,
+            feature_memory_cache_size: int = 0,
+            artifact_dir: str | None = None,
+            seed: int | None = None,
+            bucket_boundaries: list[int] | None = None,
+            dataloader_num_workers: int = 0,
+            pin_memory: bool = False,
+            persistent_workers: bool = False,
+            prefetch_factor: int | None = None,
+            metrics: PipelineMetrics | None = None,
+            log_metrics_every_n_steps: int = 0,
+            read_ahead: int = 0,
+            audio_cache_size: int = 0,
+            audio_cache_dir: str | None = None,
+            int16: bool = False
         ):
         super().__init__()
         self.desc_table = desc_table
@@ -30,68 +63,304 @@ class PhonemeDataModule(pl.LightningDataModule):
         self.dataset_dir_path = dataset_dir_path
         self.overlapping = overlapping
         self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.target_frame_rate = target_frame_rate
+        self.mono = mono
+        self.num_workers = num_workers
+        self.lazy = lazy
+        self.streaming = streaming
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.feature_cache_dir = feature_cache_dir
+        self.feature_memory_cache_size = feature_memory_cache_size
+        self.artifact_dir = artifact_dir
+        self.seed = seed
+        self.bucket_boundaries = bucket_boundaries
+        self.dataloader_num_workers = dataloader_num_workers
+        self.pin_memory = pin_memory
+        self.persistent_workers = persistent_workers
+        self.prefetch_factor = prefetch_factor
+        self.metrics = metrics
+        if metrics is not None and dataloader_num_workers > 0:
+            # the copies in the DataLoader workers publish what they record to the main process
+            metrics.share()
+        self.log_metrics_every_n_steps = log_metrics_every_n_steps
+        self._last_logged_step = None
+        self.read_ahead = read_ahead
+        # decoded files shared by all DataLoader workers of the node, bounded by audio_cache_size bytes;
+        # the ranks of a node share them through one audio_cache_dir, which is then left in place
+        self.audio_cache = SharedAudioCache(audio_cache_size, audio_cache_dir) if audio_cache_size > 0 else None
+        # frames are kept as 16-bit PCM and converted to float once a batch is on its device
+        self.int16 = int16
+        if artifact_dir is not None and seed is None:
+            raise ValueError('artifact_dir requires a seed, every node must draw the same split')
+        if feature_cache_dir is not None and seed is None:
+            raise ValueError('feature_cache_dir requires a seed, the cached features are keyed on the split')
+        if feature_cache_dir is not None and not overlapping:
+            raise ValueError('Feature caching requires frames of one length, it cannot be used with overlapping=False')
+        if lazy and (target_frame_rate is not None or mono):
+            raise ValueError('Resampling and downmixing are not supported with lazy=True')
+        if int16 and (target_frame_rate is not None or mono):
+            raise ValueError('Resampling and downmixing are not supported with int16=True')
+        if streaming and bucket_boundaries is not None:
+            raise ValueError('Length bucketing requires a map-style dataset, it cannot be used with streaming=True')
+        if streaming and feature_cache_dir is not None:
+            raise ValueError('Feature caching requires a map-style dataset, it cannot be used with streaming=True')
+        if artifact_dir is not None and (lazy or streaming):
+            raise ValueError('artifact_dir stores extracted frames, it cannot be used with lazy=True or streaming=True')
 
-    def setup(self, stage: str):
-        if stage == 'fit':
-            self.desc_table = self.desc_table.sample(frac=self.fraction).reset_index(drop='index')
-            X = self.desc_table.index
-            y = self.desc_table.class_index
-            train_indicies, val_indicies, _, _ = train_test_split(
-                X,
-                y,
-                train_size=self.train_size,
-                stratify=y,
-                shuffle=True
-            )
+    @property
+    def _use_feature_cache(self) -> bool:
+        return self.feature_cache_dir is not None and self.transform is not None
+
+    def _get_artifact_path(self) -> Path:
+        # artifacts of different corpora, framings or splits live side by side
+        fingerprint = get_dataset_fingerprint(
+            self.desc_table,
+            self.dataset_dir_path,
+            overlapping=self.overlapping,
+            frame_length=self.frame_length,
+            hop_length=self.hop_length,
+            target_frame_rate=self.target_frame_rate,
+            mono=self.mono,
+            fraction=self.fraction,
+            train_size=self.train_size,
+            seed=self.seed,
+            int16=self.int16
+        )
+        return Path(self.artifact_dir, fingerprint[:16])
+
+    def _split_desc_table(self) -> tuple[np.ndarray, np.ndarray]:
+        from sklearn.model_selection import train_test_split
 
-            self.train_dataset = PhonemeDataset(
-                audio_data=get_audio_data(
-                    desc_table=self.desc_table.iloc[train_indicies],
-                    dir_path = self.dataset_dir_path,
-                    overlapping_frames=True,
-                    frame_length=self.frame_length
+        desc_table = self.desc_table.reset_index(drop=True).sample(frac=self.fraction, random_state=self.seed)
+        train_positions, val_positions = train_test_split(
+            desc_table.index.to_numpy(),
+            train_size=self.train_size,
+            stratify=desc_table.class_index,
+            shuffle=True,
+            random_state=self.seed
+        )
+        return train_positions, val_positions
+
+    def prepare_data(self):
+        # runs once per node: the split and the frame sets are written to disk and setup
+        # on every rank only maps them read-only
+        if self.artifact_dir is None:
+            return
+        artifact_path = self._get_artifact_path()
+        artifact_path.mkdir(parents=True, exist_ok=True)
+
+        # nodes sharing the artifact directory write their own temporary files, the same seed
+        # gives them the same split and frames, so whichever is renamed last is kept
+        suffix = f'{socket.gethostname()}.{os.getpid()}.tmp'
+        split_path = Path(artifact_path, 'split.npz')
+        if not split_path.exists():
+            train_positions, val_positions = self._split_desc_table()
+            temporary_path = Path(artifact_path, f'split.{suffix}.npz')
+            np.savez(temporary_path, train=train_positions, val=val_positions)
+            os.replace(temporary_path, split_path)
+        split = np.load(split_path)
+
+        desc_table = self.desc_table.reset_index(drop=True)
+        stage = self.trainer.state.fn if self.trainer is not None else None
+        names = {'fit': ['train', 'val'], 'validate': ['val'], 'predict': ['predict']}.get(stage, ['train', 'val', 'predict'])
+        for name in names:
+            store_path = Path(artifact_path, name)
+            if Path(store_path, 'index.npy').exists():
+                continue
+            temporary_path = Path(artifact_path, f'{name}.{suffix}')
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            save_audio_data(
+                get_audio_data(
+                    desc_table=desc_table if name == 'predict' else desc_table.iloc[split[name]],
+                    dir_path=self.dataset_dir_path,
+                    overlapping_frames=self.overlapping,
+                    frame_length=self.frame_length,
+                    hop_length=self.hop_length,
+                    target_frame_rate=self.target_frame_rate,
+                    mono=self.mono,
+                    num_workers=self.num_workers,
+                    columnar=True,
+                    metrics=self.metrics,
+                    read_ahead=self.read_ahead,
+                    audio_cache=self.audio_cache,
+                    int16=self.int16
                 ),
-                transform=self.transform
+                temporary_path
             )
+            try:
+                temporary_path.rename(store_path)
+            except OSError:
+                # another node completed the store first
+                shutil.rmtree(temporary_path, ignore_errors=True)
 
-            self.val_dataset = PhonemeDataset(
-                audio_data=get_audio_data(
-                    desc_table=self.desc_table.iloc[val_indicies],
-                    dir_path = self.dataset_dir_path,
-                    overlapping_frames=True,
-                    frame_length=self.frame_length
+    def _create_dataset(
+            self,
+            desc_table: pd.DataFrame,
+            shuffle: bool = False,
+            store_path: Path | None = None
+        ) -> PhonemeDataset | LazyPhonemeDataset | StreamingPhonemeDataset | PackedPhonemeDataset | FeatureDataset:
+        if self._use_feature_cache:
+            cache_path = cache_features(
+                dataset=self._create_audio_dataset(desc_table, store_path=store_path),
+                transform=self.transform,
+                cache_dir=self.feature_cache_dir,
+                dataset_fingerprint=get_dataset_fingerprint(
+                    desc_table,
+                    self.dataset_dir_path,
+                    overlapping=self.overlapping,
+                    frame_length=self.frame_length,
+                    hop_length=self.hop_length,
+                    target_frame_rate=self.target_frame_rate,
+                    mono=self.mono
                 ),
-                transform=self.transform
+                batch_size=self.batch_size
+            )
+            return FeatureDataset(cache_path, memory_cache_size=self.feature_memory_cache_size)
+        return self._create_audio_dataset(desc_table, shuffle, store_path)
+
+    def _create_audio_dataset(
+            self,
+            desc_table: pd.DataFrame,
+            shuffle: bool = False,
+            store_path: Path | None = None
+        ) -> PhonemeDataset | LazyPhonemeDataset | StreamingPhonemeDataset | PackedPhonemeDataset:
+        if store_path is not None:
+            return PackedPhonemeDataset(store_path)
+        if self.streaming:
+            return StreamingPhonemeDataset(
+                desc_table=desc_table,
+                dir_path=self.dataset_dir_path,
+                overlapping_frames=self.overlapping,
+                frame_length=self.frame_length,
+                hop_length=self.hop_length,
+                target_frame_rate=self.target_frame_rate,
+                mono=self.mono,
+                shuffle_buffer_size=self.shuffle_buffer_size if shuffle else 0,
+                seed=self.seed,
+                read_ahead=self.read_ahead,
+                int16=self.int16,
+                metrics=self.metrics
+            )
+        if self.lazy:
+            return LazyPhonemeDataset(
+                desc_table=desc_table,
+                dir_path=self.dataset_dir_path,
+                overlapping_frames=self.overlapping,
+                frame_length=self.frame_length,
+                hop_length=self.hop_length,
+                audio_cache=self.audio_cache,
+                metrics=self.metrics,
+                int16=self.int16
             )
+        return PhonemeDataset(
+            audio_data=get_audio_data(
+                desc_table=desc_table,
+                dir_path=self.dataset_dir_path,
+                overlapping_frames=self.overlapping,
+                frame_length=self.frame_length,
+                hop_length=self.hop_length,
+                target_frame_rate=self.target_frame_rate,
+                mono=self.mono,
+                num_workers=self.num_workers,
+                columnar=True,
+                metrics=self.metrics,
+                read_ahead=self.read_ahead,
+                audio_cache=self.audio_cache,
+                int16=self.int16
+            ),
+            metrics=self.metrics
+        )
+
+    def setup(self, stage: str):
+        if self.artifact_dir is not None:
+            artifact_path = self._get_artifact_path()
+            desc_table = self.desc_table.reset_index(drop=True)
+            split = np.load(Path(artifact_path, 'split.npz'))
+            if stage == 'fit':
+                self.train_dataset = self._create_dataset(
+                    desc_table.iloc[split['train']],
+                    store_path=Path(artifact_path, 'train')
+                )
+                self.val_dataset = self._create_dataset(
+                    desc_table.iloc[split['val']],
+                    store_path=Path(artifact_path, 'val')
+                )
+            elif stage == 'predict':
+                self.predict_dataset = self._create_dataset(
+                    desc_table,
+                    store_path=Path(artifact_path, 'predict')
+                )
+        elif stage == 'fit':
+            desc_table = self.desc_table.reset_index(drop=True)
+            train_positions, val_positions = self._split_desc_table()
+
+            self.train_dataset = self._create_dataset(desc_table.iloc[train_positions], shuffle=True)
+
+            self.val_dataset = self._create_dataset(desc_table.iloc[val_positions])
         elif stage == 'predict':
-            self.predict_dataset = PhonemeDataset(
-                audio_data=get_audio_data(
-                    desc_table=self.desc_table,
-                    dir_path = self.dataset_dir_path,
-                    overlapping_frames=True,
-                    frame_length=self.frame_length
+            self.predict_dataset = self._create_dataset(self.desc_table)
+
+    def _create_dataloader(self, dataset: Any, shuffle: bool) -> DataLoader:
+        loader_params = dict(
+            collate_fn=PaddedCollate(pin_memory=self.pin_memory),
+            num_workers=self.dataloader_num_workers,
+            pin_memory=self.pin_memory,
+            persistent_workers=self.persistent_workers and self.dataloader_num_workers > 0,
+            prefetch_factor=self.prefetch_factor if self.dataloader_num_workers > 0 else None
+        )
+        if self.bucket_boundaries is not None:
+            return DataLoader(
+                dataset,
+                batch_sampler=BucketBatchSampler(
+                    dataset.lengths,
+                    self.bucket_boundaries,
+                    batch_size=self.batch_size,
+                    shuffle=shuffle,
+                    seed=self.seed
                 ),
-                transform=self.transform
+                **loader_params
             )
-
-    def train_dataloader(self):
         return DataLoader(
-                self.train_dataset,
+                dataset,
                 batch_size=self.batch_size,
-                shuffle=True
-
+                shuffle=shuffle and not self.streaming,
+                **loader_params
             )
 
+    def train_dataloader(self):
+        return self._create_dataloader(self.train_dataset, shuffle=True)
+
     def val_dataloader(self):
-        return DataLoader(
-                self.val_dataset,
-                batch_size=self.batch_size,
-                shuffle=False
-            )
+        return self._create_dataloader(self.val_dataset, shuffle=False)
 
     def predict_dataloader(self):
-        return DataLoader(
-                self.predict_dataset,
-                batch_size=self.batch_size,
-                shuffle=False
-            )
+        return self._create_dataloader(self.predict_dataset, shuffle=False)
+
+    def _log_metrics(self) -> None:
+        if self.metrics is None or self.log_metrics_every_n_steps <= 0 or self.trainer is None:
+            return
+        # validation, sanity check and predict batches and accumulated batches share the
+        # global step of the last optimizer step, the metrics are logged once per training step
+        step = self.trainer.global_step
+        if not self.trainer.training or step == self._last_logged_step:
+            return
+        if self.trainer.logger is not None and step % self.log_metrics_every_n_steps == 0:
+            self._last_logged_step = step
+            summary = self.metrics.summary()
+            if self.audio_cache is not None:
+                summary.update({f'audio_cache/{name}': value for name, value in self.audio_cache.stats.items()})
+            self.trainer.logger.log_metrics({f'data/{name}': value for name, value in summary.items()}, step=step)
+
+    def on_after_batch_transfer(self, batch: Any, dataloader_idx: int) -> Any:
+        # the transform runs once per batch on the device of the batch instead of once per frame
+        self._log_metrics()
+        if self._use_feature_cache:
+            return batch
+        data, *rest = batch
+        data = pcm_to_float(data)
+        if self.transform is None:
+            return (data, *rest)
+        with measure(self.metrics, 'batch_transform'):
+            data = self.transform.to(data.device)(data)
+        return (data, *rest)
@@ -1,14 +1,29 @@
-import tqdm
+import json
 import pandas as pd
 import numpy as np
-import textgrid
-import torchaudio
 import torch
-import pytorch_lightning as pl
-from torch.utils.data import Dataset
+import torch.nn.functional as F
+from torch.utils.data import Dataset, Sampler, BatchSampler, DistributedSampler, get_worker_info
 
+from pathlib import Path
 from dataclasses import dataclass, astuple
-from typing import Optional, Union, Any
+from typing import Optional, Union, Any, Iterator
+
+from .audio import get_frame_count, load_audio, float_to_pcm, check_pcm16
+from .cache import SharedAudioCache
+from .metrics import PipelineMetrics, measure
+# PhonemeLabeler lives with the table builders, which do not import torch
+from .utils import PhonemeLabeler
+
+
+PACKED_INDEX_DTYPE = np.dtype([
+    ('offset', np.int64),
+    ('length', np.int64),
+    ('num_channels', np.int16),
+    ('label_index', np.int16),
+    ('frame_rate', np.int32),
+    ('sample_width', np.int16)
+])
 
 
 @dataclass
@@ -22,37 +37,457 @@ class PhonemeData:
     def __iter__(self):
         return iter(astuple(self))
 
-class PhonemeLabeler:
-    def __init__(self, phoneme_classes: dict[str, list]):
-        self.phoneme_classes = phoneme_classes
+class PhonemeFrames:
+    # columnar storage for phoneme frames: one flat sample tensor and small per-frame numpy columns,
+    # labels and (frame_rate, sample_width) pairs are interned instead of being repeated per frame
+    def __init__(
+            self,
+            samples: torch.Tensor,
+            offsets: np.ndarray,
+            lengths: np.ndarray,
+            num_channels: int,
+            label_indices: np.ndarray,
+            labels: dict[int, str],
+            format_indices: np.ndarray,
+            audio_formats: np.ndarray
+        ) -> None:
+        self.samples = samples
+        self.offsets = offsets
+        self.lengths = lengths
+        self.num_channels = num_channels
+        self.label_indices = label_indices
+        self.labels = labels
+        self.format_indices = format_indices
+        self.audio_formats = audio_formats
+
+    @classmethod
+    def from_list(cls, audio_data: list[PhonemeData]) -> 'PhonemeFrames':
+        num_channels = {phoneme_data.data.shape[0] for phoneme_data in audio_data}
+        if len(num_channels) > 1:
+            raise ValueError(f'All frames must have the same number of channels, got {sorted(num_channels)}')
+        num_channels = num_channels.pop() if num_channels else 1
 
-    def __getitem__(self, phoneme_label: str) -> str:
-        for phoneme_class, phoneme_labels in self.phoneme_classes.items():
-            if phoneme_label in phoneme_labels:
-                return phoneme_class
+        lengths = np.array([phoneme_data.data.shape[-1] for phoneme_data in audio_data], dtype=np.int64)
+        offsets = np.cumsum(lengths * num_channels) - lengths * num_channels
+        if audio_data:
+            samples = torch.cat([torch.as_tensor(phoneme_data.data).reshape(-1) for phoneme_data in audio_data])
         else:
-            return 'others'
-    
-    def get_index_of_phoneme(self, phoneme_label: str):
-        return list(self.phoneme_classes.keys()).index(phoneme_label)
+            samples = torch.zeros(0)
+        audio_formats, format_indices = np.unique(
+            np.array([(phoneme_data.frame_rate, phoneme_data.sample_width) for phoneme_data in audio_data], dtype=np.int32).reshape(-1, 2),
+            axis=0,
+            return_inverse=True
+        )
+        return cls(
+            samples=samples,
+            offsets=offsets,
+            lengths=lengths,
+            num_channels=num_channels,
+            label_indices=np.array([phoneme_data.label_index for phoneme_data in audio_data], dtype=np.int16),
+            labels={int(phoneme_data.label_index): phoneme_data.label for phoneme_data in audio_data},
+            format_indices=format_indices.reshape(-1).astype(np.int16),
+            audio_formats=audio_formats
+        )
+
+    @classmethod
+    def from_segments(
+            cls,
+            segments: list[torch.Tensor],
+            label_indices: np.ndarray,
+            labels: dict[int, str],
+            audio_formats: np.ndarray
+        ) -> 'PhonemeFrames':
+        # every segment is a (frames, channels, length) tensor, its class index and
+        # (frame_rate, sample_width) pair are repeated for each of its frames
+        num_channels = {frames.shape[1] for frames in segments}
+        if len(num_channels) > 1:
+            raise ValueError(f'All frames must have the same number of channels, got {sorted(num_channels)}')
+        num_channels = num_channels.pop() if num_channels else 1
+
+        counts = np.array([frames.shape[0] for frames in segments], dtype=np.int64)
+        lengths = np.repeat(np.array([frames.shape[-1] for frames in segments], dtype=np.int64), counts)
+        offsets = np.cumsum(lengths * num_channels) - lengths * num_channels
+        samples = torch.empty(int((lengths * num_channels).sum()), dtype=segments[0].dtype if segments else torch.float32)
+        position = 0
+        for frames in segments:
+            # overlapping frames are views of the segment, they are copied once into the block
+            samples[position: position + frames.numel()].view(frames.shape).copy_(frames)
+            position += frames.numel()
+        audio_formats, format_indices = np.unique(
+            np.asarray(audio_formats, dtype=np.int32).reshape(-1, 2),
+            axis=0,
+            return_inverse=True
+        )
+        return cls(
+            samples=samples,
+            offsets=offsets,
+            lengths=lengths,
+            num_channels=num_channels,
+            label_indices=np.repeat(np.asarray(label_indices, dtype=np.int16), counts),
+            labels=labels,
+            format_indices=np.repeat(format_indices.reshape(-1), counts).astype(np.int16),
+            audio_formats=audio_formats
+        )
+
+    @classmethod
+    def concatenate(cls, blocks: list['PhonemeFrames']) -> 'PhonemeFrames':
+        # blocks are removed from the list as soon as they are copied, so the peak memory stays
+        # close to one copy of the samples
+        if not blocks:
+            return cls.from_list([])
+        num_channels = {block.num_channels for block in blocks if len(block)} or {blocks[0].num_channels}
+        if len(num_channels) > 1:
+            raise ValueError(f'All frames must have the same number of channels, got {sorted(num_channels)}')
+
+        audio_formats = np.unique(np.concatenate([block.audio_formats for block in blocks]).reshape(-1, 2), axis=0)
+        format_positions = {tuple(audio_format): i for i, audio_format in enumerate(audio_formats.tolist())}
+        dtypes = [block.samples.dtype for block in blocks if len(block)] or [blocks[0].samples.dtype]
+        samples = torch.empty(sum(block.samples.numel() for block in blocks), dtype=dtypes[0])
+        offsets, lengths, label_indices, format_indices, labels = list(), list(), list(), list(), dict()
+        position = 0
+        while blocks:
+            block = blocks.pop(0)
+            samples[position: position + block.samples.numel()] = block.samples
+            offsets.append(block.offsets + position)
+            lengths.append(block.lengths)
+            label_indices.append(block.label_indices)
+            format_map = np.array([format_positions[tuple(audio_format)] for audio_format in block.audio_formats.tolist()], dtype=np.int16)
+            format_indices.append(format_map[block.format_indices] if len(format_map) else block.format_indices)
+            labels.update(block.labels)
+            position += block.samples.numel()
+        return cls(
+            samples=samples,
+            offsets=np.concatenate(offsets),
+            lengths=np.concatenate(lengths),
+            num_channels=num_channels.pop(),
+            label_indices=np.concatenate(label_indices),
+            labels=labels,
+            format_indices=np.concatenate(format_indices).astype(np.int16),
+            audio_formats=audio_formats
+        )
+
+    def __getstate__(self) -> dict:
+        # samples are pickled as one numpy buffer, torch would pass the tensor to another process
+        # through a shared memory file descriptor
+        state = self.__dict__.copy()
+        state['samples'] = self.samples.numpy()
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        state['samples'] = torch.from_numpy(state['samples'])
+        self.__dict__.update(state)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def __getitem__(self, index: int | slice | np.ndarray | list[int]) -> Union[PhonemeData, 'PhonemeFrames']:
+        if isinstance(index, (int, np.integer)):
+            offset, length = self.offsets[index], self.lengths[index]
+            frame_rate, sample_width = self.audio_formats[self.format_indices[index]]
+            label_index = int(self.label_indices[index])
+            return PhonemeData(
+                data=self.samples[offset: offset + self.num_channels * length].view(self.num_channels, length),
+                label=self.labels[label_index],
+                label_index=label_index,
+                frame_rate=int(frame_rate),
+                sample_width=int(sample_width)
+            )
+        # a subset shares the sample tensor and only copies the per-frame columns
+        return PhonemeFrames(
+            samples=self.samples,
+            offsets=self.offsets[index],
+            lengths=self.lengths[index],
+            num_channels=self.num_channels,
+            label_indices=self.label_indices[index],
+            labels=self.labels,
+            format_indices=self.format_indices[index],
+            audio_formats=self.audio_formats
+        )
+
+    def get_batch(self, indices: np.ndarray | list[int]) -> tuple[torch.Tensor, torch.Tensor]:
+        # a single gather over the flat sample tensor for frames of equal length
+        lengths = self.lengths[indices]
+        if len(lengths) and (lengths != lengths[0]).any():
+            raise ValueError('get_batch requires frames of equal length')
+        length = int(lengths[0]) if len(lengths) else 0
+        positions = torch.from_numpy(self.offsets[indices])[:, None] + torch.arange(self.num_channels * length)
+        data = self.samples[positions].view(len(lengths), self.num_channels, length)
+        return data, torch.from_numpy(self.label_indices[indices].astype(np.int64))
 
 class PhonemeDataset(Dataset):
     def __init__(
             self,
-            audio_data: list[PhonemeData],
-            transform: torch.nn.Module | torch.nn.Sequential | None = None
+            audio_data: list[PhonemeData] | PhonemeFrames,
+            transform: torch.nn.Module | torch.nn.Sequential | None = None,
+            metrics: PipelineMetrics | None = None
         ) -> None:
         super().__init__()
         self.audio_data = audio_data
         self.transform = transform
+        # every DataLoader worker records into its own copy of the metrics, shared metrics
+        # publish the copies to the main process
+        self.metrics = metrics
     
     def __len__(self):
         return len(self.audio_data)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        if isinstance(self.audio_data, PhonemeFrames):
+            return self.audio_data.lengths
+        return np.array([audio_data.data.shape[-1] for audio_data in self.audio_data], dtype=np.int64)
     
     def __getitem__(self, index: int) -> Any:
-        # TODO: pass default transform = nn.Indentity()
+        # the stored frame is never overwritten, so transforms do not pile up across epochs
+        audio_data = self.audio_data[index]
+        data = audio_data.data
         if self.transform:
-            audio_data = self.audio_data[index]
-            audio_data.data = self.transform(audio_data.data)
-            return audio_data, self.audio_data[index].label_index
-        return self.audio_data[index].data, self.audio_data[index].label_index
+            with measure(self.metrics, 'transform'):
+                data = self.transform(data)
+        if self.metrics is not None:
+            self.metrics.increment('samples')
+        return data, audio_data.label_index
+
+
+class LazyPhonemeDataset(Dataset):
+    def __init__(
+            self,
+            desc_table: pd.DataFrame,
+            dir_path: str,
+            overlapping_frames: bool = True,
+            frame_length: int | None = 1024,
+            hop_length: int | None = None,
+            padding_length: int | None = None,
+            transform: torch.nn.Module | torch.nn.Sequential | None = None,
+            audio_cache: SharedAudioCache | None = None,
+            metrics: PipelineMetrics | None = None,
+            int16: bool = False
+        ) -> None:
+        super().__init__()
+        self.dir_path = dir_path
+        self.audio_cache = audio_cache
+        self.metrics = metrics
+        self.int16 = int16
+        self.padding_length = padding_length if overlapping_frames else None
+        self.frame_length = frame_length if overlapping_frames and padding_length is None else None
+        self.hop_length = frame_length // 2 if hop_length is None and self.frame_length is not None else hop_length
+        self.transform = transform
+
+        import torchaudio
+
+        # only the headers of the audio files are read here, samples are read in __getitem__
+        self.audio_file_paths, file_indices = np.unique(desc_table.audio_file_path.to_numpy(), return_inverse=True)
+        metadata = [torchaudio.info(Path(dir_path, audio_file_path)) for audio_file_path in self.audio_file_paths]
+        self.num_channels = np.array([info.num_channels for info in metadata])
+        if int16:
+            for audio_file_path, info in zip(self.audio_file_paths, metadata):
+                check_pcm16(audio_file_path, info.bits_per_sample)
+        frame_rates = np.array([int(info.sample_rate) for info in metadata])[file_indices]
+        num_frames = np.array([int(info.num_frames) for info in metadata])[file_indices]
+        # segments are sliced from the file as in extraction, so they end with the file
+        t0 = np.clip(np.round(desc_table.t0.to_numpy() * frame_rates), 0, num_frames).astype(np.int64)
+        t1 = np.clip(np.round(desc_table.t1.to_numpy() * frame_rates), 0, num_frames).astype(np.int64)
+        segment_lengths = np.maximum(t1 - t0, 0)
+
+        if self.frame_length is None:
+            frame_counts = np.ones_like(segment_lengths)
+        else:
+            frame_counts = get_frame_count(segment_lengths, self.frame_length, self.hop_length)
+        rows = np.repeat(np.arange(len(segment_lengths)), frame_counts)
+        frame_positions = np.arange(len(rows)) - np.repeat(np.cumsum(frame_counts) - frame_counts, frame_counts)
+
+        self.file_indices = file_indices[rows].astype(np.int32)
+        self.label_indices = desc_table.class_index.to_numpy()[rows]
+        if self.frame_length is None:
+            self.offsets = t0[rows]
+            self.lengths = segment_lengths[rows]
+        else:
+            self.offsets = t0[rows] + frame_positions * self.hop_length
+            self.lengths = np.minimum(self.frame_length, segment_lengths[rows] - frame_positions * self.hop_length)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> Any:
+        import torchaudio
+
+        file_index = self.file_indices[index]
+        length = int(self.lengths[index])
+        if length > 0 and self.audio_cache is not None:
+            # the whole file is decoded once and the neighbouring phonemes drawn by any worker
+            # are sliced from the shared copy
+            data, _, _ = load_audio(
+                Path(self.dir_path, self.audio_file_paths[file_index]),
+                audio_cache=self.audio_cache,
+                metrics=self.metrics
+            )
+            data = data[:, int(self.offsets[index]): int(self.offsets[index]) + length]
+        elif length > 0:
+            with measure(self.metrics, 'decode'):
+                data, _ = torchaudio.load(
+                    Path(self.dir_path, self.audio_file_paths[file_index]),
+                    frame_offset=int(self.offsets[index]),
+                    num_frames=length
+                )
+        else:
+            data = torch.zeros(self.num_channels[file_index], 0)
+        if self.int16:
+            data = float_to_pcm(data)
+
+        if self.frame_length is not None:
+            data = F.pad(data, (0, self.frame_length - data.shape[1]), 'constant', 0.0)
+        elif self.padding_length is not None:
+            data = F.pad(data, (0, self.padding_length - data.shape[1]), 'constant', 0.0)
+
+        if self.transform:
+            with measure(self.metrics, 'transform'):
+                data = self.transform(data)
+        if self.metrics is not None:
+            self.metrics.increment('samples')
+        return data, self.label_indices[index]
+
+
+class PackedPhonemeDataset(Dataset):
+    def __init__(
+            self,
+            store_path: str,
+            transform: torch.nn.Module | torch.nn.Sequential | None = None
+        ) -> None:
+        super().__init__()
+        self.store_path = store_path
+        self.transform = transform
+        self.index = np.load(Path(store_path, 'index.npy'))
+        with open(Path(store_path, 'labels.json'), mode='r') as file:
+            self.labels = {int(label_index): label for label_index, label in json.load(file).items()}
+        self._samples = None
+
+    @property
+    def samples(self) -> np.ndarray:
+        # copy-on-write mapping: pages stay shared in the page cache until someone writes to them
+        if self._samples is None:
+            self._samples = np.load(Path(self.store_path, 'samples.npy'), mmap_mode='c')
+        return self._samples
+
+    def __getstate__(self) -> dict:
+        # DataLoader workers map the file themselves instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state['_samples'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self.index['length']
+
+    def __getitem__(self, index: int) -> Any:
+        offset, length, num_channels, label_index, _, _ = self.index[index]
+        data = torch.from_numpy(self.samples[offset: offset + num_channels * length]).view(num_channels, length)
+        if self.transform:
+            data = self.transform(data)
+        return data, int(label_index)
+
+
+class BucketBatchSampler(BatchSampler):
+    def __init__(
+            self,
+            lengths: np.ndarray,
+            bucket_boundaries: list[int],
+            batch_size: int,
+            shuffle: bool = True,
+            drop_last: bool = False,
+            seed: int | None = None,
+            sampler: Sampler | None = None,
+            num_replicas: int | None = None,
+            rank: int | None = None
+        ) -> None:
+        # under DDP Lightning rebuilds the sampler with a DistributedSampler as sampler, only its
+        # num_replicas and rank are taken, the batches are drawn from the buckets as without it
+        if isinstance(sampler, DistributedSampler):
+            num_replicas = sampler.num_replicas if num_replicas is None else num_replicas
+            rank = sampler.rank if rank is None else rank
+        self.lengths = lengths
+        self.bucket_boundaries = bucket_boundaries
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sampler = sampler
+        self.num_replicas = 1 if num_replicas is None else num_replicas
+        self.rank = 0 if rank is None else rank
+        # every replica must draw the same batches to take its disjoint share of them
+        self.seed = 0 if seed is None and self.num_replicas > 1 else seed
+        self.epoch = 0
+
+        # indices are grouped by bucket once, every epoch only shuffles inside the buckets
+        bucket_ids = np.digitize(np.asarray(lengths), bucket_boundaries)
+        self.indices = np.argsort(bucket_ids, kind='stable')
+        self.bucket_stops = np.cumsum(np.bincount(bucket_ids, minlength=len(bucket_boundaries) + 1))
+        self.bucket_starts = self.bucket_stops - np.bincount(bucket_ids, minlength=len(bucket_boundaries) + 1)
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def _get_num_batches(self) -> int:
+        bucket_sizes = self.bucket_stops - self.bucket_starts
+        if self.drop_last:
+            return int((bucket_sizes // self.batch_size).sum())
+        return int(np.ceil(bucket_sizes / self.batch_size).sum())
+
+    def __iter__(self) -> Iterator[list[int]]:
+        # Lightning does not call set_epoch on batch samplers, so every pass advances the epoch
+        rng = np.random.default_rng(None if self.seed is None else [self.seed, self.epoch])
+        self.epoch += 1
+        batches = list()
+        for start, stop in zip(self.bucket_starts, self.bucket_stops):
+            bucket = self.indices[start:stop]
+            if self.shuffle:
+                bucket = rng.permutation(bucket)
+            if self.drop_last:
+                bucket = bucket[:len(bucket) - len(bucket) % self.batch_size]
+            batches.extend(np.split(bucket, np.arange(self.batch_size, len(bucket), self.batch_size)) if len(bucket) else [])
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        if self.num_replicas > 1 and batches:
+            # every replica yields the same number of batches, the first ones are repeated to fill
+            # up the last round, or the incomplete round is dropped with drop_last
+            batches = [batches[i % len(batches)] for i in range(self.rank, len(self) * self.num_replicas, self.num_replicas)]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return self._get_num_batches() // self.num_replicas
+        return -(-self._get_num_batches() // self.num_replicas)
+
+
+class PaddedCollate:
+    def __init__(self, pin_memory: bool = False) -> None:
+        self.pin_memory = pin_memory
+
+    def _get_buffer(self, shape: tuple[int, ...], dtype: torch.dtype) -> torch.Tensor:
+        # every batch gets its own tensor, callers may keep it; pinned tensors come from the
+        # caching host allocator of torch, which reuses their blocks once they are freed.
+        # batches collated in DataLoader workers are moved to shared memory by the DataLoader
+        # and pinned by its pin_memory thread
+        pin_memory = self.pin_memory and get_worker_info() is None and torch.cuda.is_available()
+        return torch.empty(shape, dtype=dtype, pin_memory=pin_memory)
+
+    def __call__(
+            self,
+            batch: list[tuple[torch.Tensor, int]]
+        ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        lengths = torch.tensor([data.shape[-1] for data, _ in batch])
+        max_length = int(lengths.max())
+        first = batch[0][0]
+        data = self._get_buffer((len(batch), *first.shape[:-1], max_length), first.dtype)
+        for i, (sample, _) in enumerate(batch):
+            data[i, ..., :sample.shape[-1]] = sample
+            data[i, ..., sample.shape[-1]:] = 0
+        mask = torch.arange(max_length)[None, :] < lengths[:, None]
+        labels = torch.tensor([int(label_index) for _, label_index in batch])
+        return data, labels, lengths, mask
+
@@ -0,0 +1,338 @@
+import math
+import json
+import pandas as pd
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from pathlib import Path
+from typing import Iterator
+from itertools import islice
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from .audio import frame_audio, normalize_audio, load_audio, float_to_pcm, check_pcm16
+from .cache import SharedAudioCache
+from .dataset import PhonemeData, PhonemeFrames, PACKED_INDEX_DTYPE
+from .metrics import PipelineMetrics, measure
+
+
+def _get_phoneme_frames(
+        data: torch.Tensor,
+        t0: float,
+        t1: float,
+        frame_rate: int,
+        overlapping_frames: bool,
+        frame_length: int | None,
+        hop_length: int | None,
+        padding_length: int | None,
+        metrics: PipelineMetrics | None = None
+    ) -> tuple[torch.Tensor, int]:
+    # the frames of a segment are returned as one (frames, channels, length) tensor with their count
+    with measure(metrics, 'slice'):
+        t0 = round(t0 * frame_rate)
+        t1 = round(t1 * frame_rate)
+        data = data[:, t0:t1]
+
+    if overlapping_frames is False:
+        return data[None], 1
+    elif padding_length is not None:
+        with measure(metrics, 'pad'):
+            new_shape = padding_length - data.shape[1]
+            data = F.pad(data, (0, new_shape), 'constant', 0.0)
+        return data[None], 1
+    else:
+        with measure(metrics, 'frame'):
+            frames = frame_audio(data, frame_length, hop_length)
+        return frames, frames.shape[0]
+
+def _get_file_audio_data(
+        audio_file_path: str,
+        file_rows: pd.DataFrame,
+        dir_path: str,
+        overlapping_frames: bool,
+        frame_length: int | None,
+        hop_length: int | None,
+        padding_length: int | None,
+        target_frame_rate: int | None = None,
+        mono: bool = False,
+        metrics: PipelineMetrics | None = None,
+        audio_file: bytes | None = None,
+        audio_cache: SharedAudioCache | None = None,
+        int16: bool = False
+    ) -> tuple[list[torch.Tensor], int, int]:
+    # the framed segments of the rows of a file with the frame rate and sample width they share
+    data, frame_rate, sample_width = load_audio(Path(dir_path, audio_file_path), audio_file, audio_cache, metrics)
+    with measure(metrics, 'normalize'):
+        data, frame_rate = normalize_audio(data, frame_rate, target_frame_rate, mono)
+    if int16:
+        check_pcm16(audio_file_path, sample_width)
+        # frames are sliced from the converted file and stay int16 until a batch is converted back
+        data = float_to_pcm(data)
+    segments, num_frames = list(), 0
+    for t0, t1 in zip(file_rows.t0.tolist(), file_rows.t1.tolist()):
+        frames, frame_count = _get_phoneme_frames(
+            data,
+            float(t0),
+            float(t1),
+            frame_rate,
+            overlapping_frames,
+            frame_length,
+            hop_length,
+            padding_length,
+            metrics
+        )
+        segments.append(frames)
+        num_frames += frame_count
+    if metrics is not None:
+        metrics.increment('segments', len(segments))
+        metrics.increment('frames_produced', num_frames)
+    return segments, frame_rate, sample_width
+
+def _get_phoneme_data(
+        segments: list[torch.Tensor],
+        file_rows: pd.DataFrame,
+        frame_rate: int,
+        sample_width: int
+    ) -> list[list[PhonemeData]]:
+    # the label and index of a row are read once and shared by the frames of its segment
+    return [
+        [
+            PhonemeData(
+                data=frame,
+                label=label,
+                label_index=label_index,
+                frame_rate=frame_rate,
+                sample_width=sample_width
+            )
+            for frame in frames.unbind(0)
+        ]
+        for frames, label, label_index in zip(segments, file_rows.phone_class.tolist(), file_rows.class_index.tolist())
+    ]
+
+def _read_ahead(
+        file_groups: list[tuple[str, pd.DataFrame]],
+        dir_path: str,
+        read_ahead: int = 0,
+        metrics: PipelineMetrics | None = None
+    ) -> Iterator[tuple[str, pd.DataFrame, bytes | None]]:
+    # the bytes of the next read_ahead files are read by a thread pool in table order while
+    # the current file is decoded and framed, the reads release the GIL
+    if read_ahead <= 0:
+        for audio_file_path, file_rows in file_groups:
+            yield audio_file_path, file_rows, None
+        return
+
+    def read_file(audio_file_path: str) -> bytes:
+        return Path(dir_path, audio_file_path).read_bytes()
+
+    file_groups = iter(file_groups)
+    with ThreadPoolExecutor(max_workers=read_ahead) as executor:
+        pending = deque(
+            (audio_file_path, file_rows, executor.submit(read_file, audio_file_path))
+            for audio_file_path, file_rows in islice(file_groups, read_ahead)
+        )
+        while pending:
+            audio_file_path, file_rows, future = pending.popleft()
+            for next_file_path, next_file_rows in islice(file_groups, 1):
+                pending.append((next_file_path, next_file_rows, executor.submit(read_file, next_file_path)))
+            with measure(metrics, 'read_wait'):
+                audio_file = future.result()
+            yield audio_file_path, file_rows, audio_file
+
+def _get_files_audio_data(
+        file_groups: list[tuple[str, pd.DataFrame]],
+        dir_path: str,
+        overlapping_frames: bool,
+        frame_length: int | None,
+        hop_length: int | None,
+        padding_length: int | None,
+        target_frame_rate: int | None = None,
+        mono: bool = False,
+        metrics: PipelineMetrics | None = None,
+        read_ahead: int = 0,
+        audio_cache: SharedAudioCache | None = None,
+        int16: bool = False
+    ) -> tuple[list[PhonemeFrames], list[np.ndarray], PipelineMetrics | None]:
+    # the frames of a chunk of files are returned as columnar blocks with the position in
+    # desc_table of every frame, one block per channel count so that corpora mixing mono and
+    # stereo files can still be returned as a list; the metrics of a worker process are
+    # merged by the parent
+    groups, labels = dict(), dict()
+    for audio_file_path, file_rows, audio_file in _read_ahead(file_groups, dir_path, read_ahead, metrics):
+        file_segments, frame_rate, sample_width = _get_file_audio_data(
+            audio_file_path,
+            file_rows,
+            dir_path,
+            overlapping_frames,
+            frame_length,
+            hop_length,
+            padding_length,
+            target_frame_rate,
+            mono,
+            metrics,
+            audio_file,
+            audio_cache,
+            int16
+        )
+        file_label_indices = file_rows.class_index.tolist()
+        labels.update(zip(file_label_indices, file_rows.phone_class.tolist()))
+        positions = file_rows.index.tolist()
+        for frames, label_index, position in zip(file_segments, file_label_indices, positions):
+            segments, label_indices, audio_formats, rows = groups.setdefault(frames.shape[1], (list(), list(), list(), list()))
+            segments.append(frames)
+            label_indices.append(label_index)
+            audio_formats.append((frame_rate, sample_width))
+            rows.extend([position] * frames.shape[0])
+    blocks, block_rows = list(), list()
+    for segments, label_indices, audio_formats, rows in groups.values():
+        blocks.append(PhonemeFrames.from_segments(segments, np.array(label_indices, dtype=np.int16), labels, np.array(audio_formats)))
+        block_rows.append(np.array(rows, dtype=np.int64))
+    return blocks, block_rows, metrics
+
+def get_audio_data(
+        desc_table: pd.DataFrame,
+        dir_path: str,
+        overlapping_frames: bool = True,
+        frame_length: int | None = 1024,
+        hop_length: int | None = None,
+        padding_length: int | None = None,
+        num_workers: int = 0,
+        columnar: bool = False,
+        target_frame_rate: int | None = None,
+        mono: bool = False,
+        metrics: PipelineMetrics | None = None,
+        read_ahead: int = 0,
+        audio_cache: SharedAudioCache | None = None,
+        int16: bool = False
+    ) -> list[PhonemeData] | PhonemeFrames:
+    import tqdm
+
+    if int16 and (target_frame_rate is not None or mono):
+        raise ValueError('Resampling and downmixing are not supported with int16=True')
+
+    # every audio file is probed and decoded once, all of its phonemes are sliced
+    # from the same buffer and the frames are put back in the order of desc_table
+    file_groups = list(desc_table.reset_index(drop=True).groupby('audio_file_path', sort=False, observed=True))
+    # files are processed in chunks that each become columnar blocks, so that worker tasks
+    # amortize the cost of pickling and columnar storage never holds all frames twice
+    chunk_size = max(1, min(64, math.ceil(len(file_groups) / (num_workers * 4)))) if num_workers > 0 else 64
+    chunks = [file_groups[i: i + chunk_size] for i in range(0, len(file_groups), chunk_size)]
+    blocks, block_rows = list(), list()
+    with tqdm.tqdm(total=desc_table.shape[0]) as progress_bar:
+        if num_workers > 0:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {
+                    executor.submit(
+                        _get_files_audio_data,
+                        chunk,
+                        dir_path,
+                        overlapping_frames,
+                        frame_length,
+                        hop_length,
+                        padding_length,
+                        target_frame_rate,
+                        mono,
+                        None if metrics is None else PipelineMetrics(),
+                        read_ahead,
+                        audio_cache,
+                        int16
+                    ): chunk
+                    for chunk in chunks
+                }
+                for future in as_completed(futures):
+                    chunk_blocks, chunk_rows, chunk_metrics = future.result()
+                    if metrics is not None:
+                        metrics.merge(chunk_metrics)
+                    blocks.extend(chunk_blocks)
+                    block_rows.extend(chunk_rows)
+                    progress_bar.update(sum(file_rows.shape[0] for _, file_rows in futures[future]))
+        elif columnar:
+            for chunk in chunks:
+                chunk_blocks, chunk_rows, _ = _get_files_audio_data(
+                    chunk,
+                    dir_path,
+                    overlapping_frames,
+                    frame_length,
+                    hop_length,
+                    padding_length,
+                    target_frame_rate,
+                    mono,
+                    metrics,
+                    read_ahead,
+                    audio_cache,
+                    int16
+                )
+                blocks.extend(chunk_blocks)
+                block_rows.extend(chunk_rows)
+                progress_bar.update(sum(file_rows.shape[0] for _, file_rows in chunk))
+        else:
+            phoneme_frames = [None] * desc_table.shape[0]
+            for audio_file_path, file_rows, audio_file in _read_ahead(file_groups, dir_path, read_ahead, metrics):
+                segments, frame_rate, sample_width = _get_file_audio_data(
+                    audio_file_path,
+                    file_rows,
+                    dir_path,
+                    overlapping_frames,
+                    frame_length,
+                    hop_length,
+                    padding_length,
+                    target_frame_rate,
+                    mono,
+                    metrics,
+                    audio_file,
+                    audio_cache,
+                    int16
+                )
+                file_frames = _get_phoneme_data(segments, file_rows, frame_rate, sample_width)
+                for position, frames in zip(file_rows.index, file_frames):
+                    phoneme_frames[position] = frames
+                progress_bar.update(file_rows.shape[0])
+
+    if num_workers > 0 or columnar:
+        # the blocks are merged and put back in the order of desc_table
+        order = np.argsort(np.concatenate([np.zeros(0, dtype=np.int64), *block_rows]), kind='stable')
+        if columnar:
+            return PhonemeFrames.concatenate(blocks)[order]
+        # a list holds frames of any channel count, as the serial path returns them
+        frames = [frame for block in blocks for frame in block]
+        return [frames[i] for i in order]
+    return [frame for frames in phoneme_frames for frame in frames]
+
+def save_audio_data(audio_data: list[PhonemeData] | PhonemeFrames, store_path: str) -> None:
+    # all frames are flattened into one contiguous array that PackedPhonemeDataset maps back
+    Path(store_path).mkdir(parents=True, exist_ok=True)
+    index = np.zeros(len(audio_data), dtype=PACKED_INDEX_DTYPE)
+    labels = dict()
+    offset = 0
+    for i, phoneme_data in enumerate(audio_data):
+        num_channels, length = phoneme_data.data.shape
+        index[i] = (
+            offset,
+            length,
+            num_channels,
+            phoneme_data.label_index,
+            phoneme_data.frame_rate,
+            phoneme_data.sample_width
+        )
+        labels[int(phoneme_data.label_index)] = phoneme_data.label
+        offset += num_channels * length
+
+    # int16 frames are stored as int16, the dtype is recorded in the header of samples.npy
+    if isinstance(audio_data, PhonemeFrames):
+        is_int16 = audio_data.samples.dtype == torch.int16
+    else:
+        is_int16 = len(audio_data) > 0 and torch.as_tensor(audio_data[0].data).dtype == torch.int16
+    samples = np.lib.format.open_memmap(
+        Path(store_path, 'samples.npy'),
+        mode='w+',
+        dtype=np.int16 if is_int16 else np.float32,
+        shape=(offset,)
+    )
+    for (offset, length, num_channels, _, _, _), phoneme_data in zip(index, audio_data):
+        samples[offset: offset + num_channels * length] = torch.as_tensor(phoneme_data.data).reshape(-1).numpy()
+    samples.flush()
+    del samples
+
+    np.save(Path(store_path, 'index.npy'), index)
+    with open(Path(store_path, 'labels.json'), mode='w') as file:
+        json.dump(labels, file)
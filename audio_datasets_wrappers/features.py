@@ -0,0 +1,148 @@
+import os
+import json
+import shutil
+import socket
+import hashlib
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from pathlib import Path
+from collections import OrderedDict
+from typing import Any
+
+from .audio import pcm_to_float
+
+
+def _is_scalar(value: Any) -> bool:
+    if isinstance(value, (tuple, list)):
+        return all(_is_scalar(item) for item in value)
+    return value is None or isinstance(value, (bool, int, float, str))
+
+def get_transform_fingerprint(transform: torch.nn.Module) -> str:
+    # the configuration of a module is in its repr and in the scalar attributes of it and its
+    # submodules, torchaudio transforms leave hop_length, power and the like out of their repr;
+    # weights and filterbanks are in the state dict
+    fingerprint = hashlib.sha1(repr(transform).encode())
+    for module_name, module in transform.named_modules():
+        attributes = {
+            name: value
+            for name, value in vars(module).items()
+            if not name.startswith('_') and name != 'training' and _is_scalar(value)
+        }
+        fingerprint.update(repr((module_name, type(module).__qualname__, sorted(attributes.items()))).encode())
+    for name, tensor in sorted(transform.state_dict().items()):
+        fingerprint.update(name.encode())
+        fingerprint.update(str((tensor.dtype, tuple(tensor.shape))).encode())
+        fingerprint.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return fingerprint.hexdigest()
+
+def get_dataset_fingerprint(desc_table: pd.DataFrame, dir_path: str, **params: Any) -> str:
+    fingerprint = hashlib.sha1(json.dumps([str(Path(dir_path).resolve()), params], sort_keys=True).encode())
+    rows = desc_table[['audio_file_path', 't0', 't1', 'class_index']].astype({
+        'audio_file_path': str,
+        't0': np.float64,
+        't1': np.float64,
+        'class_index': np.int64
+    })
+    fingerprint.update(pd.util.hash_pandas_object(rows, index=False).to_numpy().tobytes())
+    return fingerprint.hexdigest()
+
+def _stack_frames(batch: list[tuple[torch.Tensor, int]]) -> tuple[torch.Tensor, torch.Tensor]:
+    data, label_indices = zip(*batch)
+    if len({frame.shape for frame in data}) > 1:
+        raise ValueError('Feature caching requires frames of one shape, frame or pad the segments')
+    return torch.stack(data), torch.tensor(label_indices)
+
+def cache_features(
+        dataset: Dataset,
+        transform: torch.nn.Module,
+        cache_dir: str,
+        dataset_fingerprint: str,
+        batch_size: int = 256,
+        num_workers: int = 0,
+        device: str | torch.device = 'cpu'
+    ) -> Path:
+    # features are computed once per (transform, dataset) pair and reused by later epochs and runs
+    cache_key = hashlib.sha1((get_transform_fingerprint(transform) + dataset_fingerprint).encode()).hexdigest()
+    cache_path = Path(cache_dir, cache_key)
+    if Path(cache_path, 'labels.npy').exists():
+        return cache_path
+
+    # every rank may compute the same features into a directory shared between nodes
+    temporary_path = cache_path.with_name(f'{cache_key}.{socket.gethostname()}.{os.getpid()}.tmp')
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    temporary_path.mkdir(parents=True)
+
+    transform = transform.to(device)
+    features, labels, position = None, np.zeros(len(dataset), dtype=np.int16), 0
+    with torch.inference_mode():
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers, collate_fn=_stack_frames)
+        for data, label_indices in loader:
+            batch_features = transform(pcm_to_float(data.to(device))).cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    Path(temporary_path, 'features.npy'),
+                    mode='w+',
+                    dtype=batch_features.dtype,
+                    shape=(len(dataset), *batch_features.shape[1:])
+                )
+            if batch_features.shape[1:] != features.shape[1:]:
+                raise ValueError('Feature caching requires frames of one shape, frame or pad the segments')
+            features[position: position + len(batch_features)] = batch_features
+            labels[position: position + len(batch_features)] = label_indices.numpy()
+            position += len(batch_features)
+    if features is not None:
+        features.flush()
+        del features
+    np.save(Path(temporary_path, 'labels.npy'), labels)
+    try:
+        temporary_path.rename(cache_path)
+    except OSError:
+        # another process cached the same features first
+        shutil.rmtree(temporary_path, ignore_errors=True)
+    return cache_path
+
+
+class FeatureDataset(Dataset):
+    def __init__(self, cache_path: str, memory_cache_size: int = 0) -> None:
+        super().__init__()
+        self.cache_path = cache_path
+        self.labels = np.load(Path(cache_path, 'labels.npy'))
+        self.memory_cache_size = memory_cache_size
+        self._memory_cache = OrderedDict()
+        self._features = None
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            self._features = np.load(Path(self.cache_path, 'features.npy'), mmap_mode='c')
+        return self._features
+
+    @property
+    def lengths(self) -> np.ndarray:
+        # every feature has the shape of the first one, the last axis is its length
+        return np.full(len(self.labels), self.features.shape[-1] if len(self.labels) > 0 else 0, dtype=np.int64)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['_features'] = None
+        state['_memory_cache'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index: int) -> Any:
+        if self.memory_cache_size <= 0:
+            return torch.from_numpy(self.features[index]), int(self.labels[index])
+
+        # bounded LRU tier in front of the memory-mapped features
+        if index in self._memory_cache:
+            self._memory_cache.move_to_end(index)
+        else:
+            self._memory_cache[index] = torch.from_numpy(np.array(self.features[index]))
+            if len(self._memory_cache) > self.memory_cache_size:
+                self._memory_cache.popitem(last=False)
+        return self._memory_cache[index], int(self.labels[index])
@@ -0,0 +1,157 @@
+import os
+import time
+import pickle
+import numpy as np
+
+from pathlib import Path
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, ContextManager, Iterator
+
+from .shared import create_shared_dir, check_process
+
+# upper bounds of the timing histogram buckets, four per decade from 1 µs to 100 s
+TIMING_BUCKETS = 10.0 ** (np.arange(-24, 9) / 4)
+
+class PipelineMetrics:
+    def __init__(self, callback: Callable[[str, float], None] | None = None, flush_interval: float = 5.0) -> None:
+        self.callback = callback
+        self.flush_interval = flush_interval
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(lambda: np.zeros(len(TIMING_BUCKETS) + 1, dtype=np.int64))
+        self.totals = defaultdict(float)
+        self.shared_dir = None
+        self._owner_pid = self._pid = os.getpid()
+        self._path = None
+        self._last_flush = time.monotonic()
+
+    def __getstate__(self) -> dict:
+        # copies sent to worker processes are merged back without the callback of the parent
+        return {
+            'callback': None,
+            'flush_interval': self.flush_interval,
+            'counters': dict(self.counters),
+            'histograms': dict(self.histograms),
+            'totals': dict(self.totals),
+            'shared_dir': self.shared_dir,
+            'pid': self._pid
+        }
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['callback'], state['flush_interval'])
+        self.counters.update(state['counters'])
+        self.histograms.update(state['histograms'])
+        self.totals.update(state['totals'])
+        # a copy unpickled in a spawned worker is recognised as one by the pid of its origin
+        self.shared_dir = state['shared_dir']
+        self._owner_pid = self._pid = state['pid']
+
+    def share(self, shared_dir: str | None = None) -> None:
+        # copies of the metrics in other processes, forked or spawned DataLoader workers included,
+        # start empty and publish what they record to one file each in a tmpfs directory every
+        # flush_interval seconds and at exit; summary() of the owner merges the files
+        if self.shared_dir is not None:
+            return
+        if shared_dir is None:
+            shared_dir, self._finalizer = create_shared_dir(self, 'pipeline-metrics-')
+        Path(shared_dir).mkdir(parents=True, exist_ok=True)
+        self.shared_dir = shared_dir
+
+    def _reset_process_state(self) -> None:
+        # what the copy inherited stays with the parent, the file name also tells apart
+        # workers that reuse the pid of an earlier one
+        self._pid = os.getpid()
+        self.callback = None
+        self.counters.clear()
+        self.histograms.clear()
+        self.totals.clear()
+        self._path = Path(self.shared_dir, f'{self._pid}-{time.time_ns()}.pkl')
+        self._last_flush = time.monotonic()
+
+    def _check_process(self) -> None:
+        if self.shared_dir is not None:
+            check_process(self, self._pid, self._reset_process_state, self.flush)
+
+    def _maybe_flush(self) -> None:
+        if self._path is not None and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._path is None:
+            return
+        temporary_path = self._path.with_suffix('.tmp')
+        with open(temporary_path, mode='wb') as file:
+            pickle.dump(self, file)
+        os.replace(temporary_path, self._path)
+        self._last_flush = time.monotonic()
+
+    def _collect(self) -> 'PipelineMetrics':
+        metrics = PipelineMetrics()
+        metrics.merge(self)
+        for path in Path(self.shared_dir).glob('*.pkl'):
+            try:
+                with open(path, mode='rb') as file:
+                    metrics.merge(pickle.load(file))
+            except FileNotFoundError:
+                continue
+        return metrics
+
+    def increment(self, name: str, value: int = 1) -> None:
+        self._check_process()
+        self.counters[name] += value
+        self._maybe_flush()
+
+    def record_time(self, stage: str, seconds: float) -> None:
+        self._check_process()
+        self.histograms[stage][np.searchsorted(TIMING_BUCKETS, seconds)] += 1
+        self.totals[stage] += seconds
+        if self.callback is not None:
+            self.callback(stage, seconds)
+        self._maybe_flush()
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(stage, time.perf_counter() - start)
+
+    def merge(self, other: 'PipelineMetrics') -> None:
+        for name, value in other.counters.items():
+            self.counters[name] += value
+        for stage, histogram in other.histograms.items():
+            self.histograms[stage] += histogram
+            self.totals[stage] += other.totals[stage]
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.histograms.clear()
+        self.totals.clear()
+        if self.shared_dir is not None and os.getpid() == self._owner_pid:
+            # workers that are still running publish their counts again at their next flush
+            for path in Path(self.shared_dir).glob('*.pkl'):
+                path.unlink(missing_ok=True)
+
+    def get_percentile(self, stage: str, percentile: float) -> float:
+        # the upper bound of the bucket holding the percentile, so it is an upper estimate
+        histogram = self.histograms[stage]
+        position = np.searchsorted(np.cumsum(histogram), percentile / 100 * histogram.sum())
+        return float(TIMING_BUCKETS[min(position, len(TIMING_BUCKETS) - 1)])
+
+    def summary(self) -> dict[str, float]:
+        if self.shared_dir is not None and os.getpid() == self._owner_pid:
+            return self._collect().summary()
+        summary = {name: float(value) for name, value in self.counters.items()}
+        for stage, histogram in self.histograms.items():
+            count = int(histogram.sum())
+            summary[f'{stage}/count'] = float(count)
+            summary[f'{stage}/total_s'] = self.totals[stage]
+            summary[f'{stage}/mean_ms'] = self.totals[stage] / max(count, 1) * 1000
+            summary[f'{stage}/p50_ms'] = self.get_percentile(stage, 50) * 1000
+            summary[f'{stage}/p99_ms'] = self.get_percentile(stage, 99) * 1000
+        return summary
+
+
+def measure(metrics: PipelineMetrics | None, stage: str) -> ContextManager:
+    return nullcontext() if metrics is None else metrics.timer(stage)
@@ -0,0 +1,119 @@
+import json
+import shutil
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterator
+
+from .dataset import PhonemeData, PhonemeFrames
+from .streaming import EpochCounter, get_rank_info, _balance_ranks, _get_worker_quotas
+from .extraction import save_audio_data
+
+
+def save_shards(
+        audio_data: list[PhonemeData] | PhonemeFrames,
+        shards_dir: str,
+        max_shard_size: int = 256 * 2 ** 20,
+        seed: int | None = None
+    ) -> list[str]:
+    # frames are cut into shards of about max_shard_size bytes of samples, every shard is a
+    # packed store with its own small index; with a seed the frames are permuted before cutting so
+    # that every shard holds a mix of speakers and classes
+    if isinstance(audio_data, PhonemeFrames):
+        sizes = audio_data.lengths * audio_data.num_channels * audio_data.samples.element_size()
+    else:
+        sizes = np.array(
+            [phoneme_data.data.numel() * phoneme_data.data.element_size() for phoneme_data in audio_data],
+            dtype=np.int64
+        )
+    order = np.arange(len(audio_data)) if seed is None else np.random.default_rng(seed).permutation(len(audio_data))
+    shard_ids = (np.cumsum(sizes[order]) - sizes[order]) // max_shard_size
+
+    Path(shards_dir).mkdir(parents=True, exist_ok=True)
+    shards = list()
+    for shard_id in np.unique(shard_ids):
+        positions = order[shard_ids == shard_id]
+        name = f'shard-{len(shards):05d}'
+        temporary_path = Path(shards_dir, f'{name}.tmp')
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        if isinstance(audio_data, PhonemeFrames):
+            save_audio_data(audio_data[positions], temporary_path)
+        else:
+            save_audio_data([audio_data[position] for position in positions], temporary_path)
+        shutil.rmtree(Path(shards_dir, name), ignore_errors=True)
+        temporary_path.rename(Path(shards_dir, name))
+        shards.append({'name': name, 'num_frames': len(positions)})
+
+    with open(Path(shards_dir, 'shards.json'), mode='w') as file:
+        json.dump({'shards': shards}, file)
+    return [shard['name'] for shard in shards]
+
+
+class ShardedPhonemeDataset(IterableDataset):
+    def __init__(
+            self,
+            shards_dir: str,
+            shuffle: bool = False,
+            seed: int | None = None,
+            transform: torch.nn.Module | torch.nn.Sequential | None = None
+        ) -> None:
+        super().__init__()
+        self.shards_dir = shards_dir
+        with open(Path(shards_dir, 'shards.json'), mode='r') as file:
+            self.shards = json.load(file)['shards']
+        self.shuffle = shuffle
+        self.seed = seed
+        self.transform = transform
+        self.epoch_counter = EpochCounter()
+        self.rank_info = get_rank_info()
+        if len(self.shards) < self.rank_info[1]:
+            raise ValueError(f'{len(self.shards)} shards cannot be split across {self.rank_info[1]} ranks, save smaller shards')
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch_counter.set_epoch(epoch)
+
+    def _iter_shard(self, name: str, rng: np.random.Generator | None) -> Iterator[tuple[torch.Tensor, int]]:
+        # a shard is read whole with one sequential read instead of a random access per frame
+        index = np.load(Path(self.shards_dir, name, 'index.npy'))
+        samples = torch.from_numpy(np.load(Path(self.shards_dir, name, 'samples.npy')))
+        positions = np.arange(len(index)) if rng is None else rng.permutation(len(index))
+        for offset, length, num_channels, label_index, _, _ in index[positions]:
+            yield samples[offset: offset + num_channels * length].view(int(num_channels), int(length)), int(label_index)
+
+    def _iter_frames(self, names: list[str], rng: np.random.Generator | None) -> Iterator[tuple[torch.Tensor, int]]:
+        # the shards are read again, with frames in a new order when shuffling, until the
+        # caller has taken its quota
+        while names:
+            for name in names:
+                yield from self._iter_shard(name, rng)
+
+    def __iter__(self) -> Iterator[Any]:
+        # every rank and worker sees the same shard order for an epoch and takes a disjoint
+        # part of it; with fewer shards than workers some workers get none
+        rank, world_size = self.rank_info
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        epoch = self.epoch_counter.next_epoch()
+        order = np.arange(len(self.shards))
+        rng = None
+        if self.shuffle:
+            order = np.random.default_rng([self.seed or 0, epoch]).permutation(len(self.shards))
+            rng = np.random.default_rng([self.seed or 0, epoch, rank * num_workers + worker_id])
+
+        # shards are balanced across the ranks by their frame counts, shards of equal size go to
+        # different ranks as the order changes; under DDP every rank yields as many frames as the
+        # one with the most, the others repeat frames instead of dropping any
+        num_frames = np.array([shard['num_frames'] for shard in self.shards], dtype=np.int64)[order]
+        ranks, rank_totals = _balance_ranks(num_frames, world_size)
+        rank_order, num_frames = order[ranks == rank], num_frames[ranks == rank]
+        worker_totals = np.array([num_frames[i::num_workers].sum() for i in range(num_workers)])
+        worker_quotas = _get_worker_quotas(worker_totals, int(rank_totals.max()))
+
+        names = [self.shards[i]['name'] for i in rank_order[worker_id::num_workers]]
+        for data, label_index in islice(self._iter_frames(names, rng), int(worker_quotas[worker_id])):
+            if self.transform:
+                data = self.transform(data)
+            yield data, label_index
@@ -0,0 +1,27 @@
+import os
+import shutil
+import weakref
+import tempfile
+import multiprocessing.util
+
+from pathlib import Path
+from typing import Any, Callable
+
+
+def _remove_shared_dir(shared_dir: str, owner_pid: int) -> None:
+    # forked workers inherit the finalizer with their copy of the owner, only the owner removes it
+    if os.getpid() == owner_pid:
+        shutil.rmtree(shared_dir, ignore_errors=True)
+
+def create_shared_dir(owner: Any, prefix: str) -> tuple[str, weakref.finalize]:
+    # a tmpfs directory removed with the object that created it, or at exit of its process
+    shm_dir = '/dev/shm' if Path('/dev/shm').is_dir() else tempfile.gettempdir()
+    shared_dir = tempfile.mkdtemp(prefix=prefix, dir=shm_dir)
+    return shared_dir, weakref.finalize(owner, _remove_shared_dir, shared_dir, os.getpid())
+
+def check_process(owner: Any, pid: int, reset: Callable[[], None], flush: Callable[[], None]) -> None:
+    # a copy of owner in a forked or spawned process, found by the pid it last ran in, starts
+    # from a fresh process state and flushes what it adds at exit
+    if os.getpid() != pid:
+        reset()
+        multiprocessing.util.Finalize(owner, flush, exitpriority=0)
@@ -0,0 +1,204 @@
+import multiprocessing
+import numpy as np
+import pandas as pd
+import torch
+import torch.distributed as dist
+from torch.utils.data import IterableDataset, get_worker_info
+
+from itertools import islice
+from pathlib import Path
+from typing import Any, Iterator
+
+from .audio import get_frame_count
+from .metrics import PipelineMetrics, measure
+from .extraction import _get_file_audio_data, _read_ahead
+
+
+def get_rank_info() -> tuple[int, int]:
+    # DataLoader workers do not inherit the process group, datasets take the rank when they are
+    # created on their rank and hand it to get_shard_info
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+def get_shard_info(rank_info: tuple[int, int] | None = None) -> tuple[int, int]:
+    # the position of the current DataLoader worker among all workers of all distributed ranks
+    rank, world_size = get_rank_info() if rank_info is None else rank_info
+    worker_info = get_worker_info()
+    if worker_info is None:
+        return rank, world_size
+    return rank * worker_info.num_workers + worker_info.id, world_size * worker_info.num_workers
+
+
+class EpochCounter:
+    def __init__(self) -> None:
+        # the first epoch and the number of __iter__ calls live in shared memory, so DataLoader
+        # workers, persistent or not, advance the same count as the main process; every worker
+        # calls __iter__ once per epoch
+        self.state = multiprocessing.Array('q', 2)
+
+    def set_epoch(self, epoch: int) -> None:
+        with self.state.get_lock():
+            self.state[0], self.state[1] = epoch, 0
+
+    def next_epoch(self) -> int:
+        worker_info = get_worker_info()
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        with self.state.get_lock():
+            epoch, calls = self.state[0], self.state[1]
+            self.state[1] += 1
+        return epoch + calls // num_workers
+
+
+def _balance_ranks(counts: np.ndarray, world_size: int) -> tuple[np.ndarray, np.ndarray]:
+    # the largest files go first, each to the rank with the fewest frames so far
+    ranks = np.empty(len(counts), dtype=np.int64)
+    totals = np.zeros(world_size, dtype=np.int64)
+    for position in np.argsort(-counts, kind='stable'):
+        rank = int(np.argmin(totals))
+        ranks[position] = rank
+        totals[rank] += counts[position]
+    return ranks, totals
+
+def _get_worker_quotas(worker_totals: np.ndarray, budget: int) -> np.ndarray:
+    # the frame budget of a rank split across its workers: a budget below the frames of the rank
+    # is filled by the workers in order, a larger one is made up by every worker repeating its
+    # frames in proportion to how many it has
+    total = int(worker_totals.sum())
+    if budget <= total or total == 0:
+        return np.clip(budget - (np.cumsum(worker_totals) - worker_totals), 0, worker_totals)
+    quotas = worker_totals + (budget - total) * worker_totals // total
+    quotas[np.flatnonzero(worker_totals)[:budget - int(quotas.sum())]] += 1
+    return quotas
+
+
+class StreamingPhonemeDataset(IterableDataset):
+    def __init__(
+            self,
+            desc_table: pd.DataFrame,
+            dir_path: str,
+            overlapping_frames: bool = True,
+            frame_length: int | None = 1024,
+            hop_length: int | None = None,
+            padding_length: int | None = None,
+            target_frame_rate: int | None = None,
+            mono: bool = False,
+            shuffle_buffer_size: int = 0,
+            seed: int | None = None,
+            transform: torch.nn.Module | torch.nn.Sequential | None = None,
+            read_ahead: int = 0,
+            int16: bool = False,
+            metrics: PipelineMetrics | None = None
+        ) -> None:
+        super().__init__()
+        self.file_groups = list(desc_table.reset_index(drop=True).groupby('audio_file_path', sort=False, observed=True))
+        self.dir_path = dir_path
+        self.overlapping_frames = overlapping_frames
+        self.frame_length = frame_length
+        self.hop_length = hop_length
+        self.padding_length = padding_length
+        self.target_frame_rate = target_frame_rate
+        self.mono = mono
+        self.shuffle_buffer_size = shuffle_buffer_size
+        # without a seed every process draws one, the epoch still changes the order
+        self.seed = int(np.random.SeedSequence().entropy % 2 ** 63) if seed is None else seed
+        self.transform = transform
+        self.read_ahead = read_ahead
+        self.int16 = int16
+        self.metrics = metrics
+        self.epoch_counter = EpochCounter()
+        self.rank_info = get_rank_info()
+        # the frame counts of the files balance the distributed ranks, they are only known from
+        # the file headers
+        self.frame_counts = self._get_frame_counts() if self.rank_info[1] > 1 else None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch_counter.set_epoch(epoch)
+
+    def _get_frame_counts(self) -> np.ndarray:
+        import torchaudio
+
+        if not self.overlapping_frames or self.padding_length is not None:
+            return np.array([len(file_rows) for _, file_rows in self.file_groups], dtype=np.int64)
+        frame_counts = np.empty(len(self.file_groups), dtype=np.int64)
+        for i, (audio_file_path, file_rows) in enumerate(self.file_groups):
+            info = torchaudio.info(Path(self.dir_path, audio_file_path))
+            frame_rate, num_frames = int(info.sample_rate), int(info.num_frames)
+            if self.target_frame_rate is not None and self.target_frame_rate != frame_rate:
+                num_frames = -(-num_frames * self.target_frame_rate // frame_rate)
+                frame_rate = self.target_frame_rate
+            # segments are sliced from the file as in extraction, so they end with the file
+            t0 = np.clip(np.round(file_rows.t0.to_numpy(dtype=np.float64) * frame_rate), 0, num_frames).astype(np.int64)
+            t1 = np.clip(np.round(file_rows.t1.to_numpy(dtype=np.float64) * frame_rate), 0, num_frames).astype(np.int64)
+            frame_counts[i] = get_frame_count(np.maximum(t1 - t0, 0), self.frame_length, self.hop_length).sum()
+        return frame_counts
+
+    def _iter_frames(self, file_groups: list[tuple[str, pd.DataFrame]]) -> Iterator[tuple[torch.Tensor, int]]:
+        for audio_file_path, file_rows, audio_file in _read_ahead(file_groups, self.dir_path, self.read_ahead, self.metrics):
+            segments, _, _ = _get_file_audio_data(
+                audio_file_path,
+                file_rows,
+                self.dir_path,
+                self.overlapping_frames,
+                self.frame_length,
+                self.hop_length,
+                self.padding_length,
+                self.target_frame_rate,
+                self.mono,
+                metrics=self.metrics,
+                audio_file=audio_file,
+                int16=self.int16
+            )
+            for frames, label_index in zip(segments, file_rows.class_index.tolist()):
+                for frame in frames:
+                    yield frame, label_index
+
+    def _get_worker_files(self) -> tuple[np.ndarray, int | None]:
+        # files are split disjointly across ranks and workers before any shuffling; under DDP
+        # every rank must yield as many frames as the others, so the files are balanced by
+        # their frame counts and every rank stops at the count of the smallest one
+        rank, world_size = self.rank_info
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        positions = np.arange(len(self.file_groups))
+        if world_size == 1:
+            return positions[worker_id::num_workers], None
+
+        ranks, totals = _balance_ranks(self.frame_counts, world_size)
+        positions = positions[ranks == rank]
+        worker_totals = np.array([self.frame_counts[positions[i::num_workers]].sum() for i in range(num_workers)])
+        worker_quotas = _get_worker_quotas(worker_totals, int(totals.min()))
+        return positions[worker_id::num_workers], int(worker_quotas[worker_id])
+
+    def __iter__(self) -> Iterator[Any]:
+        shard_id, _ = get_shard_info(self.rank_info)
+        positions, max_frames = self._get_worker_files()
+        rng = np.random.default_rng([self.seed, self.epoch_counter.next_epoch(), shard_id])
+
+        if self.shuffle_buffer_size > 0:
+            rng.shuffle(positions)
+        frames = self._iter_frames([self.file_groups[position] for position in positions])
+        if max_frames is not None:
+            frames = islice(frames, max_frames)
+        if self.shuffle_buffer_size > 0:
+            frames = self._shuffle(frames, rng)
+
+        for data, label_index in frames:
+            if self.transform:
+                with measure(self.metrics, 'transform'):
+                    data = self.transform(data)
+            if self.metrics is not None:
+                self.metrics.increment('samples')
+            yield data, label_index
+
+    def _shuffle(self, frames: Iterator[Any], rng: np.random.Generator) -> Iterator[Any]:
+        buffer = list()
+        for frame in frames:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(frame)
+                continue
+            i = rng.integers(len(buffer))
+            buffer[i], frame = frame, buffer[i]
+            yield frame
+        rng.shuffle(buffer)
+        yield from buffer
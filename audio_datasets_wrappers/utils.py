@@ -1,17 +1,24 @@
+import os
 import re
 import json
-import tqdm
+import hashlib
+import math
+import functools
+import importlib
 import pandas as pd
 import platform
-import textgrid
-import torchaudio
-import torch.nn.functional as F
+import numpy as np
 
 from pathlib import Path
-from dataset import PhonemeLabeler, PhonemeData
+from typing import Callable
+from concurrent.futures import ProcessPoolExecutor
+from .metrics import PipelineMetrics, measure
 
 TIMIT_CONSTANT = 15987
 
+# bump when the rows produced by the builders change, it invalidates cached tables
+DESCRIPTION_TABLE_VERSION = 1
+
 COLUMNS = [
     'phone_name',
     'phone_class',
@@ -26,88 +33,170 @@ COLUMNS = [
     't1'
 ]
 
-with open(file='timit_dialects.json', mode='r') as file:
-    TIMIT_DIALECTS = json.load(file)
+CATEGORICAL_COLUMNS = [
+    'phone_name',
+    'phone_class',
+    'usage',
+    'speaker_id',
+    'gender',
+    'dialect',
+    'allignment_file_path',
+    'audio_file_path'
+]
+
+class PhonemeLabeler:
+    def __init__(self, phoneme_classes: dict[str, list]):
+        self.phoneme_classes = phoneme_classes
+        # inverted maps are compiled once, the first class listing a phoneme wins as in a linear scan
+        self.class_indices = {phoneme_class: i for i, phoneme_class in enumerate(phoneme_classes)}
+        self.phoneme_to_class = dict()
+        for phoneme_class, phoneme_labels in reversed(phoneme_classes.items()):
+            self.phoneme_to_class.update(dict.fromkeys(phoneme_labels, phoneme_class))
 
-with open(file='arctic_speakers.json', mode='r') as file:
-    ARCTIC_SPEAKERS = json.load(file)
+    def __getitem__(self, phoneme_label: str) -> str:
+        return self.phoneme_to_class.get(phoneme_label, 'others')
+    
+    def get_index_of_phoneme(self, phoneme_label: str):
+        try:
+            return self.class_indices[phoneme_label]
+        except KeyError:
+            raise ValueError(f'{phoneme_label!r} is not in list') from None
+
+    def label_column(self, phoneme_labels: pd.Series | np.ndarray) -> tuple[pd.Categorical, np.ndarray]:
+        # classes of a whole column of phonemes as a categorical and their class indices as codes
+        phoneme_labels = pd.Series(phoneme_labels, dtype=object)
+        phoneme_classes = pd.Categorical(
+            phoneme_labels.map(self.phoneme_to_class).fillna('others'),
+            categories=list(self.class_indices)
+        )
+        class_indices = phoneme_classes.codes
+        if (class_indices < 0).any():
+            unknown = phoneme_labels[class_indices < 0].map(self.phoneme_to_class).fillna('others').iloc[0]
+            raise ValueError(f'{unknown!r} is not in list')
+        return phoneme_classes, class_indices
+
+@functools.lru_cache(maxsize=None)
+def _load_metadata(file_name: str) -> dict:
+    # the metadata is shipped next to this module and read on first use, not at import
+    with open(file=Path(__file__).with_name(file_name), mode='r') as file:
+        return json.load(file)
 
 def remove_digits(phoneme_name: str) -> str:
     return re.sub(r'[0-9]+', '', phoneme_name)
 
-def create_timit_discription_table(dir_path: str, phoneme_labeler: PhonemeLabeler) -> pd.DataFrame:
+def _label_description_table(desc_table: pd.DataFrame, phoneme_labeler: PhonemeLabeler) -> pd.DataFrame:
+    phone_classes, class_indices = phoneme_labeler.label_column(desc_table.phone_name)
+    desc_table['phone_class'] = np.asarray(phone_classes, dtype=object)
+    desc_table['class_index'] = class_indices.astype(np.int64)
+    return desc_table
+
+def compact_description_table(desc_table: pd.DataFrame) -> pd.DataFrame:
+    # repeated strings become categoricals, for the path columns the codes are per-file ids
+    # and the categories are the file table; times are float32 and class indices the smallest int
+    desc_table = desc_table.copy()
+    for column in CATEGORICAL_COLUMNS:
+        desc_table[column] = desc_table[column].astype('category')
+    desc_table['class_index'] = pd.to_numeric(desc_table['class_index'], downcast='integer')
+    desc_table['t0'] = desc_table['t0'].astype(np.float32)
+    desc_table['t1'] = desc_table['t1'].astype(np.float32)
+    return desc_table
+
+def _parse_timit_file(allignment_file: Path, audio_file: Path) -> list[list]:
     data = list()
 
     slash = '\\' if platform.system() == 'Windows' else '/'
 
-    for allignment_file, audio_file in zip(
-        sorted(Path(dir_path).glob('*/*/*/*.PHN')),
-        sorted(Path(dir_path).glob('*/*/*/*.WAV.wav'))
-        ):
-        with open(allignment_file) as labels:
-            usage, dialect, dictor_id, filename = str(allignment_file).split(slash)[-4:]
-            for label in labels:
-                label = label.split()
-                phoneme_name = label[2].upper()
-                start = round(int(label[0]) / TIMIT_CONSTANT, 3)
-                end = round(int(label[1]) / TIMIT_CONSTANT, 3)
-
-                data.append([
-                    phoneme_name,                         # ARPABET code
-                    phoneme_labeler[phoneme_name],   # class of phonemes
-                    phoneme_labeler.get_index_of_phoneme(
-                        phoneme_labeler[phoneme_name]
-                        ),
-                    usage,                              # TEST or TRAIN
-                    dictor_id,
-                    dictor_id[0],
-                    TIMIT_DIALECTS[dialect],
-                    '/'.join(map(str, [usage, dialect, dictor_id, filename])),
-                    '/'.join(map(str, str(audio_file).split(slash)[-4:])),
-                    start,
-                    end
-                ])
-    
-    return pd.DataFrame(data=data, columns=COLUMNS)
+    with open(allignment_file) as labels:
+        usage, dialect, dictor_id, filename = str(allignment_file).split(slash)[-4:]
+        for label in labels:
+            label = label.split()
+            phoneme_name = label[2].upper()
+            start = round(int(label[0]) / TIMIT_CONSTANT, 3)
+            end = round(int(label[1]) / TIMIT_CONSTANT, 3)
+
+            data.append([
+                phoneme_name,                         # ARPABET code
+                None,                               # class of phonemes
+                None,
+                usage,                              # TEST or TRAIN
+                dictor_id,
+                dictor_id[0],
+                _load_metadata('timit_dialects.json')[dialect],
+                '/'.join(map(str, [usage, dialect, dictor_id, filename])),
+                '/'.join(map(str, str(audio_file).split(slash)[-4:])),
+                start,
+                end
+            ])
+
+    return data
+
+def _parse_arctic_file(textgrid_file: Path, wav_file: Path, speaker: str) -> list[list]:
+    import textgrid
 
-def create_arctic_discription_table(dir_path: str, phoneme_labeler: PhonemeLabeler) -> pd.DataFrame:
     data = list()
 
     slash = '\\' if platform.system() == 'Windows' else '/'
 
+    for interval in textgrid.TextGrid.fromFile(textgrid_file)[1]:
+        phoneme_name = remove_digits(interval.mark)
+        data.append([
+            phoneme_name,
+            None,
+            None,
+            None,
+            speaker,
+            _load_metadata('arctic_speakers.json')[speaker]['gender'],
+            _load_metadata('arctic_speakers.json')[speaker]['country'],
+            '/'.join(map(str, str(textgrid_file).split(slash)[-3:])),
+            '/'.join(map(str, str(wav_file).split(slash)[-3:])),
+            interval.minTime,
+            interval.maxTime
+        ])
+
+    return data
+
+def _parse_librispeech_file(textgrid_file: Path, flac_file: Path, usage: str) -> list[list]:
+    import textgrid
+
+    data = list()
+
+    slash = '\\' if platform.system() == 'Windows' else '/'
+
+    for interval in textgrid.TextGrid.fromFile(textgrid_file)[1]:
+        data.append([
+            interval.mark,
+            None,
+            None,
+            usage, 
+            None, # speaker id (?)
+            None, # speaker sex (?),
+            None, # speaker dialect?
+            '/'.join(map(str, str(textgrid_file).split(slash)[-4:])),
+            '/'.join(map(str, str(flac_file).split(slash)[-4:])),
+            interval.minTime,
+            interval.maxTime
+        ])
+
+    return data
+
+def _list_timit_files(dir_path: str) -> list[tuple]:
+    return list(zip(
+        sorted(Path(dir_path).glob('*/*/*/*.PHN')),
+        sorted(Path(dir_path).glob('*/*/*/*.WAV.wav'))
+    ))
+
+def _list_arctic_files(dir_path: str) -> list[tuple]:
+    files = list()
     for speaker_dir in Path(dir_path).iterdir():
         for textgrid_file, wav_file in zip(
                 sorted(Path(speaker_dir, 'textgrid').iterdir()),
                 sorted(Path(speaker_dir, 'wav').iterdir())
-            ): 
-            table_rows = list()
-            for interval in textgrid.TextGrid.fromFile(textgrid_file)[1]:
-                phoneme_name = remove_digits(interval.mark)
-                table_rows.append([
-                    phoneme_name,
-                    phoneme_labeler[phoneme_name],
-                    phoneme_labeler.get_index_of_phoneme(
-                        phoneme_labeler[phoneme_name]
-                        ),
-                    None,
-                    speaker_dir.stem,
-                    ARCTIC_SPEAKERS[speaker_dir.stem]['gender'],
-                    ARCTIC_SPEAKERS[speaker_dir.stem]['country'],
-                    '/'.join(map(str, str(textgrid_file).split(slash)[-3:])),
-                    '/'.join(map(str, str(wav_file).split(slash)[-3:])),
-                    interval.minTime,
-                    interval.maxTime
-                ])
-                
-            data.extend(table_rows)
-    
-        return pd.DataFrame(data=data, columns=COLUMNS)
-    
-def create_librispeech_description_table(dir_path: str, phoneme_labeler: PhonemeLabeler) -> pd.DataFrame:
-    data = list()
-
-    slash = '\\' if platform.system() == 'Windows' else '/'
+            ):
+            files.append((textgrid_file, wav_file, speaker_dir.stem))
+    return files
 
+def _list_librispeech_files(dir_path: str) -> list[tuple]:
+    files = list()
     for directory in Path(dir_path).iterdir():
         data_type, usage = str(directory.stem).split('-')
         for sub_directory in directory.iterdir():
@@ -115,86 +204,176 @@ def create_librispeech_description_table(dir_path: str, phoneme_labeler: Phoneme
                 sorted(sub_directory.glob('*/*.TextGrid')),
                 sorted(sub_directory.glob('*/*.flac'))
                 ):
-                table_rows = list()
-                for interval in textgrid.TextGrid.fromFile(textgrid_file)[1]:
-                    table_rows.append([
-                        interval.mark,
-                        phoneme_labeler[interval.mark],
-                        phoneme_labeler.get_index_of_phoneme(
-                            phoneme_labeler[interval.mark]
-                        ),
-                        usage, 
-                        None, # speaker id (?)
-                        None, # speaker sex (?),
-                        None, # speaker dialect?
-                        '/'.join(map(str, str(textgrid_file).split(slash)[-4:])),
-                        '/'.join(map(str, str(flac_file).split(slash)[-4:])),
-                        interval.minTime,
-                        interval.maxTime
-                    ])
-                data.extend(table_rows)
-    
-    return pd.DataFrame(data=data, columns=COLUMNS)
+                files.append((textgrid_file, flac_file, usage))
+    return files
 
+def _parse_files(parse_file: Callable[..., list[list]], files: list[tuple], num_workers: int = 0) -> list[list[list]]:
+    # executor.map keeps the order of files, so the parallel table is identical to the serial one
+    if num_workers > 0 and len(files) > 0:
+        chunk_size = max(1, math.ceil(len(files) / (num_workers * 4)))
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            return list(executor.map(parse_file, *zip(*files), chunksize=chunk_size))
+    return [parse_file(*file) for file in files]
 
+def _get_file_stats(file: tuple) -> tuple:
+    allignment_file, audio_file, *context = file
+    allignment_stat, audio_stat = Path(allignment_file).stat(), Path(audio_file).stat()
+    return (
+        str(audio_file),
+        allignment_stat.st_size,
+        allignment_stat.st_mtime_ns,
+        audio_stat.st_size,
+        audio_stat.st_mtime_ns,
+        *context
+    )
 
-def get_audio_data(
-        desc_table: pd.DataFrame,
+def _build_description_table(
+        builder_name: str,
+        parse_file: Callable[..., list[list]],
+        files: list[tuple],
         dir_path: str,
-        overlapping_frames: bool = True,
-        frame_length: int | None = 1024,
-        padding_length: int | None = None
-    ) -> list[PhonemeData]:
-    audio_data = list()
-    for _, row in tqdm.tqdm(desc_table.iterrows(), total=desc_table.shape[0]):
-        metadata = torchaudio.info(Path(dir_path, row.audio_file_path))
-        frame_rate = int(metadata.sample_rate)
-        sample_width = metadata.bits_per_sample
-        t0 = round(row.t0 * frame_rate)
-        t1 = round(row.t1 * frame_rate)
-
-        data, _ = torchaudio.load(Path(dir_path, row.audio_file_path))
-        data = data[:, t0:t1]
-        
-        if overlapping_frames is False:
-            audio_data.append(PhonemeData(
-                data=data,
-                label=row.phone_class,
-                label_index=row.class_index,
-                frame_rate=frame_rate,
-                sample_width=sample_width
-            ))
-        elif padding_length is not None:
-            new_shape = padding_length - data.shape[1]
-            data = F.pad(data, (0, new_shape), 'constant', 0.0)
-            audio_data.append(PhonemeData(
-                data=data,
-                label=row.phone_class,
-                label_index=row.class_index,
-                frame_rate=frame_rate,
-                sample_width=sample_width
-            ))
+        phoneme_labeler: PhonemeLabeler,
+        num_workers: int = 0,
+        cache_dir: str | None = None,
+        metrics: PipelineMetrics | None = None
+    ) -> pd.DataFrame:
+    if cache_dir is None:
+        with measure(metrics, 'parse'):
+            data = [row for rows in _parse_files(parse_file, files, num_workers) for row in rows]
+        if metrics is not None:
+            metrics.increment('files_parsed', len(files))
+            metrics.increment('rows_parsed', len(data))
+        return _label_description_table(pd.DataFrame(data=data, columns=COLUMNS), phoneme_labeler)
+
+    # the cache is keyed by the corpus, the labeler mapping and the version of the builders,
+    # inside it only the files whose path, size or mtime changed are parsed again
+    cache_key = hashlib.sha1(json.dumps([
+        builder_name,
+        str(Path(dir_path).resolve()),
+        phoneme_labeler.phoneme_classes,
+        DESCRIPTION_TABLE_VERSION
+    ]).encode()).hexdigest()
+    cache_path = Path(cache_dir, f'{builder_name}-{cache_key[:16]}.pkl')
+    cached_files, tables = dict(), list()
+    if cache_path.exists():
+        cached_files, cached_table = pd.read_pickle(cache_path)
+        tables.append(cached_table)
+    cached_size = sum(table.shape[0] for table in tables)
+
+    file_stats = [_get_file_stats(file) for file in files]
+    is_cached = [
+        str(file[0]) in cached_files and cached_files[str(file[0])][0] == stats
+        for file, stats in zip(files, file_stats)
+    ]
+    changed_files = [file for file, cached in zip(files, is_cached) if not cached]
+    with measure(metrics, 'parse'):
+        changed_rows = iter(_parse_files(parse_file, changed_files, num_workers))
+
+    # positions of every file's rows in the cached table followed by the newly parsed rows
+    new_data, positions = list(), list()
+    for file, cached in zip(files, is_cached):
+        if cached:
+            _, start, stop = cached_files[str(file[0])]
+            positions.append(np.arange(start, stop))
         else:
-            i = 0
-            frames = list()
-            for _ in range(data.shape[1] // (frame_length // 2) - 1):
-                frames.append(PhonemeData(
-                    data=data[:, i: i + frame_length],
-                    label=row.phone_class,
-                    label_index=row.class_index,
-                    frame_rate=frame_rate,
-                    sample_width=sample_width 
-                ))
-                i += frame_length // 2
-            else:
-                new_shape = frame_length - data[:, i:].shape[1]
-                frames.append(PhonemeData(
-                    data=F.pad(data[:, i:], (0, new_shape), 'constant', 0.0),
-                    label=row.phone_class,
-                    label_index=row.class_index,
-                    frame_rate=frame_rate,
-                    sample_width=sample_width 
-                ))
-            audio_data.extend(frames)
-
-    return audio_data
\ No newline at end of file
+            rows = next(changed_rows)
+            start = cached_size + len(new_data)
+            new_data.extend(rows)
+            positions.append(np.arange(start, start + len(rows)))
+    if metrics is not None:
+        metrics.increment('files_parsed', len(changed_files))
+        metrics.increment('files_cached', len(files) - len(changed_files))
+        metrics.increment('rows_parsed', len(new_data))
+
+    if new_data or not tables:
+        tables.append(pd.DataFrame(data=new_data, columns=COLUMNS))
+    combined_table = pd.concat(tables, ignore_index=True)
+    desc_table = combined_table.iloc[np.concatenate([np.zeros(0, dtype=np.int64), *positions])]
+    desc_table = _label_description_table(desc_table.reset_index(drop=True), phoneme_labeler)
+
+    stops = np.cumsum([file_positions.size for file_positions in positions], dtype=np.int64)
+    new_files = {
+        str(file[0]): (stats, stop - file_positions.size, stop)
+        for file, stats, file_positions, stop in zip(files, file_stats, positions, stops.tolist())
+    }
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    temporary_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    pd.to_pickle((new_files, desc_table), temporary_path)
+    os.replace(temporary_path, cache_path)
+
+    return desc_table
+
+def create_timit_discription_table(
+        dir_path: str,
+        phoneme_labeler: PhonemeLabeler,
+        num_workers: int = 0,
+        cache_dir: str | None = None,
+        compact: bool = False,
+        metrics: PipelineMetrics | None = None
+    ) -> pd.DataFrame:
+    with measure(metrics, 'scan'):
+        files = _list_timit_files(dir_path)
+    desc_table = _build_description_table(
+        'timit',
+        _parse_timit_file,
+        files,
+        dir_path,
+        phoneme_labeler,
+        num_workers,
+        cache_dir,
+        metrics
+    )
+    return compact_description_table(desc_table) if compact else desc_table
+
+def create_arctic_discription_table(
+        dir_path: str,
+        phoneme_labeler: PhonemeLabeler,
+        num_workers: int = 0,
+        cache_dir: str | None = None,
+        compact: bool = False,
+        metrics: PipelineMetrics | None = None
+    ) -> pd.DataFrame:
+    with measure(metrics, 'scan'):
+        files = _list_arctic_files(dir_path)
+    desc_table = _build_description_table(
+        'arctic',
+        _parse_arctic_file,
+        files,
+        dir_path,
+        phoneme_labeler,
+        num_workers,
+        cache_dir,
+        metrics
+    )
+    return compact_description_table(desc_table) if compact else desc_table
+    
+def create_librispeech_description_table(
+        dir_path: str,
+        phoneme_labeler: PhonemeLabeler,
+        num_workers: int = 0,
+        cache_dir: str | None = None,
+        compact: bool = False,
+        metrics: PipelineMetrics | None = None
+    ) -> pd.DataFrame:
+    with measure(metrics, 'scan'):
+        files = _list_librispeech_files(dir_path)
+    desc_table = _build_description_table(
+        'librispeech',
+        _parse_librispeech_file,
+        files,
+        dir_path,
+        phoneme_labeler,
+        num_workers,
+        cache_dir,
+        metrics
+    )
+    return compact_description_table(desc_table) if compact else desc_table
+
+# frame extraction needs torch and lives in extraction, the description tables are built
+# without importing it
+_EXTRACTION_EXPORTS = ['get_audio_data', 'save_audio_data']
+
+def __getattr__(name: str):
+    if name not in _EXTRACTION_EXPORTS:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    return getattr(importlib.import_module('.extraction', __package__), name)
@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+sys.path.insert(0, str(Path(__file__).parents[1]))
+
+import synthetic_corpus
+
+LAYOUTS = {
+    'timit': ('generate_timit', 'create_timit_discription_table'),
+    'arctic': ('generate_arctic', 'create_arctic_discription_table'),
+    'librispeech': ('generate_librispeech', 'create_librispeech_description_table')
+}
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / (1024 ** 2 if platform.system() == 'Darwin' else 1024)
+
+def _benchmark_table(layout: str, dir_path: str, num_workers: int) -> dict:
+    from audio_datasets_wrappers import utils
+    from audio_datasets_wrappers.utils import PhonemeLabeler
+
+    start = time.perf_counter()
+    desc_table = getattr(utils, LAYOUTS[layout][1])(dir_path, PhonemeLabeler(synthetic_corpus.PHONEME_CLASSES), num_workers=num_workers)
+    seconds = time.perf_counter() - start
+    return {
+        'rows': int(desc_table.shape[0]),
+        'files': int(desc_table.audio_file_path.nunique()),
+        'seconds': seconds,
+        'rows_per_second': desc_table.shape[0] / seconds
+    }
+
+def _benchmark_extraction(layout: str, dir_path: str, num_workers: int, frame_length: int, overlapping: bool) -> dict:
+    from audio_datasets_wrappers import utils
+    from audio_datasets_wrappers.utils import PhonemeLabeler
+    from audio_datasets_wrappers.extraction import get_audio_data
+
+    desc_table = getattr(utils, LAYOUTS[layout][1])(dir_path, PhonemeLabeler(synthetic_corpus.PHONEME_CLASSES))
+    input_bytes = sum(Path(dir_path, path).stat().st_size for path in desc_table.audio_file_path.unique())
+    start = time.perf_counter()
+    audio_data = get_audio_data(
+        desc_table,
+        dir_path,
+        overlapping_frames=overlapping,
+        frame_length=frame_length,
+        num_workers=num_workers,
+        columnar=True
+    )
+    seconds = time.perf_counter() - start
+    return {
+        'segments': int(desc_table.shape[0]),
+        'frames': len(audio_data),
+        'seconds': seconds,
+        'segments_per_second': desc_table.shape[0] / seconds,
+        'input_mb_per_second': input_bytes / 2 ** 20 / seconds,
+        'output_mb_per_second': audio_data.samples.numel() * audio_data.samples.element_size() / 2 ** 20 / seconds
+    }
+
+def _benchmark_dataloader(
+        layout: str,
+        dir_path: str,
+        frame_length: int,
+        batch_size: int,
+        dataloader_num_workers: int
+    ) -> dict:
+    from audio_datasets_wrappers import utils
+    from audio_datasets_wrappers.utils import PhonemeLabeler
+    from audio_datasets_wrappers.dataset import PhonemeDataset
+    from audio_datasets_wrappers.extraction import get_audio_data
+    from torch.utils.data import DataLoader
+
+    desc_table = getattr(utils, LAYOUTS[layout][1])(dir_path, PhonemeLabeler(synthetic_corpus.PHONEME_CLASSES))
+    dataset = PhonemeDataset(get_audio_data(desc_table, dir_path, frame_length=frame_length, columnar=True))
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=dataloader_num_workers)
+    start = time.perf_counter()
+    samples = sum(len(label_indices) for _, label_indices in loader)
+    seconds = time.perf_counter() - start
+    return {
+        'samples': samples,
+        'seconds': seconds,
+        'samples_per_second': samples / seconds
+    }
+
+def _run_isolated(queue: multiprocessing.Queue, benchmark: str, kwargs: dict) -> None:
+    result = globals()[benchmark](**kwargs)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    queue.put(result)
+
+def run_isolated(benchmark: str, **kwargs) -> dict:
+    # every benchmark runs in its own process so that peak RSS belongs to that benchmark only,
+    # the parent never imports torch and stays small
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_isolated, args=(queue, benchmark, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def _get_environment() -> dict:
+    import torch
+    import torchaudio
+    import pandas as pd
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).parents[1],
+            capture_output=True,
+            text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'torchaudio': torchaudio.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmarks of the table builders and the audio extraction on synthetic corpora')
+    parser.add_argument('--corpus-dir', default='benchmark_corpus', help='where the synthetic corpora are generated')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file with the results')
+    parser.add_argument('--layouts', nargs='+', default=list(LAYOUTS), choices=list(LAYOUTS))
+    parser.add_argument('--speakers', type=int, default=8)
+    parser.add_argument('--utterances', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=3.0, help='seconds of audio per utterance')
+    parser.add_argument('--num-workers', type=int, nargs='+', default=[0, os.cpu_count()])
+    parser.add_argument('--frame-length', type=int, default=1024)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--dataloader-num-workers', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='regenerate corpora that already exist')
+    args = parser.parse_args(argv)
+
+    results = list()
+
+    def record(**result) -> None:
+        results.append(result)
+        print(json.dumps(result))
+
+    for layout in args.layouts:
+        dir_path = str(Path(args.corpus_dir, layout))
+        if args.regenerate or not Path(dir_path).exists():
+            getattr(synthetic_corpus, LAYOUTS[layout][0])(
+                dir_path,
+                speakers=args.speakers,
+                utterances=args.utterances,
+                duration=args.duration
+            )
+
+        for num_workers in args.num_workers:
+            record(
+                benchmark='table',
+                layout=layout,
+                num_workers=num_workers,
+                **run_isolated('_benchmark_table', layout=layout, dir_path=dir_path, num_workers=num_workers)
+            )
+            for overlapping in [True, False]:
+                record(
+                    benchmark='get_audio_data',
+                    layout=layout,
+                    num_workers=num_workers,
+                    overlapping=overlapping,
+                    **run_isolated(
+                        '_benchmark_extraction',
+                        layout=layout,
+                        dir_path=dir_path,
+                        num_workers=num_workers,
+                        frame_length=args.frame_length,
+                        overlapping=overlapping
+                    )
+                )
+        record(
+            benchmark='dataloader',
+            layout=layout,
+            dataloader_num_workers=args.dataloader_num_workers,
+            **run_isolated(
+                '_benchmark_dataloader',
+                layout=layout,
+                dir_path=dir_path,
+                frame_length=args.frame_length,
+                batch_size=args.batch_size,
+                dataloader_num_workers=args.dataloader_num_workers
+            )
+        )
+
+    with open(args.output, mode='w') as file:
+        json.dump({'environment': _get_environment(), 'config': vars(args), 'results': results}, file, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import json
+import numpy as np
+import soundfile as sf
+import textgrid
+
+from pathlib import Path
+
+TIMIT_CONSTANT = 15987
+
+PHONEMES = ['AA', 'AE', 'AH', 'IY', 'UW', 'B', 'D', 'G', 'P', 'T', 'K', 'S', 'SH', 'Z', 'F', 'V', 'M', 'N', 'L', 'R']
+
+PHONEME_CLASSES = {
+    'vowels': ['AA', 'AE', 'AH', 'IY', 'UW'],
+    'stops': ['B', 'D', 'G', 'P', 'T', 'K'],
+    'fricatives': ['S', 'SH', 'Z', 'F', 'V'],
+    'others': ['M', 'N', 'L', 'R', 'H#', 'PAU', 'sil', '']
+}
+
+
+def _write_audio(path: Path, rng: np.random.Generator, frame_rate: int, duration: float) -> int:
+    length = int(frame_rate * duration)
+    samples = (rng.standard_normal(length) * 0.1).clip(-1.0, 1.0).astype(np.float32)
+    sf.write(path, samples, frame_rate, subtype='PCM_16')
+    return length
+
+def _get_boundaries(rng: np.random.Generator, length: int, phonemes_per_second: int, frame_rate: int) -> np.ndarray:
+    count = max(1, int(length / frame_rate * phonemes_per_second))
+    inner = np.sort(rng.choice(np.arange(1, length - 1), size=count - 1, replace=False))
+    return np.concatenate([[0], inner, [length]])
+
+def _write_textgrid(path: Path, rng: np.random.Generator, length: int, frame_rate: int, phonemes_per_second: int) -> None:
+    duration = length / frame_rate
+    grid = textgrid.TextGrid(maxTime=duration)
+    words = textgrid.IntervalTier('words', 0, duration)
+    words.add(0, duration, 'word')
+    phones = textgrid.IntervalTier('phones', 0, duration)
+    boundaries = _get_boundaries(rng, length, phonemes_per_second, frame_rate)
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        phones.add(start / frame_rate, end / frame_rate, str(rng.choice(PHONEMES)) + str(rng.choice(['', '0', '1'])))
+    grid.append(words)
+    grid.append(phones)
+    grid.write(str(path))
+
+def generate_timit(
+        dir_path: str,
+        speakers: int = 4,
+        utterances: int = 10,
+        duration: float = 3.0,
+        phonemes_per_second: int = 12,
+        seed: int = 0
+    ) -> None:
+    # <usage>/<dialect>/<speaker>/<utterance>.PHN next to <utterance>.WAV.wav
+    rng = np.random.default_rng(seed)
+    for speaker in range(speakers):
+        usage = 'TRAIN' if speaker % 4 else 'TEST'
+        speaker_dir = Path(dir_path, usage, f'DR{speaker % 8 + 1}', f'{"MF"[speaker % 2]}SPK{speaker}')
+        speaker_dir.mkdir(parents=True, exist_ok=True)
+        for utterance in range(utterances):
+            length = _write_audio(Path(speaker_dir, f'SX{utterance}.WAV.wav'), rng, 16000, duration)
+            boundaries = _get_boundaries(rng, length, phonemes_per_second, 16000)
+            with open(Path(speaker_dir, f'SX{utterance}.PHN'), mode='w') as file:
+                for start, end in zip(boundaries[:-1], boundaries[1:]):
+                    file.write(f'{start * TIMIT_CONSTANT // 16000} {end * TIMIT_CONSTANT // 16000} {rng.choice(PHONEMES).lower()}\n')
+
+def generate_arctic(
+        dir_path: str,
+        speakers: int = 4,
+        utterances: int = 10,
+        duration: float = 3.0,
+        phonemes_per_second: int = 12,
+        seed: int = 0
+    ) -> None:
+    # <speaker>/textgrid/*.TextGrid next to <speaker>/wav/*.wav, speakers come from arctic_speakers.json
+    rng = np.random.default_rng(seed)
+    with open(Path(__file__).parents[1] / 'audio_datasets_wrappers' / 'arctic_speakers.json', mode='r') as file:
+        speaker_names = list(json.load(file))
+    for speaker in speaker_names[:speakers]:
+        Path(dir_path, speaker, 'textgrid').mkdir(parents=True, exist_ok=True)
+        Path(dir_path, speaker, 'wav').mkdir(parents=True, exist_ok=True)
+        for utterance in range(utterances):
+            length = _write_audio(Path(dir_path, speaker, 'wav', f'arctic_a{utterance:04d}.wav'), rng, 16000, duration)
+            _write_textgrid(Path(dir_path, speaker, 'textgrid', f'arctic_a{utterance:04d}.TextGrid'), rng, length, 16000, phonemes_per_second)
+
+def generate_librispeech(
+        dir_path: str,
+        speakers: int = 4,
+        utterances: int = 10,
+        duration: float = 3.0,
+        phonemes_per_second: int = 12,
+        seed: int = 0
+    ) -> None:
+    # <type>-<usage>/<speaker>/<chapter>/*.TextGrid next to *.flac
+    rng = np.random.default_rng(seed)
+    for speaker in range(speakers):
+        chapter_dir = Path(dir_path, 'train-clean' if speaker % 4 else 'test-clean', str(100 + speaker), str(1000 + speaker))
+        chapter_dir.mkdir(parents=True, exist_ok=True)
+        for utterance in range(utterances):
+            name = f'{100 + speaker}-{1000 + speaker}-{utterance:04d}'
+            length = _write_audio(Path(chapter_dir, f'{name}.flac'), rng, 16000, duration)
+            _write_textgrid(Path(chapter_dir, f'{name}.TextGrid'), rng, length, 16000, phonemes_per_second)
@@ -11,6 +11,12 @@ setup(
     author_email='zaitsev808@mail.ru',
 
     packages=['audio_datasets_wrappers'],
+    package_data={'audio_datasets_wrappers': ['*.json']},
+    entry_points={
+        'console_scripts': [
+            'audio-datasets-prepare=audio_datasets_wrappers.cli:main',
+        ]
+    },
     install_requires=[
         'numpy',
         'pandas',
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile
+import torch
+
+from audio_datasets_wrappers.extraction import get_audio_data
+
+FRAME_RATE = 16000
+
+
+@pytest.fixture(scope='module')
+def mixed_corpus(tmp_path_factory):
+    # mono and stereo files interleaved in the table
+    dir_path = tmp_path_factory.mktemp('mixed')
+    rng = np.random.default_rng(0)
+    rows = list()
+    for i in range(4):
+        audio_file_path = f'speaker{i}.wav'
+        samples = rng.uniform(-0.5, 0.5, size=(FRAME_RATE // 2, 1 + i % 2)).astype(np.float32)
+        soundfile.write(dir_path / audio_file_path, samples, FRAME_RATE, subtype='PCM_16')
+        for j, (t0, t1) in enumerate([(0.0, 0.11), (0.2, 0.45)]):
+            rows.append(dict(phone_class=f'class{j}', class_index=j, audio_file_path=audio_file_path, t0=t0, t1=t1))
+    return pd.DataFrame(rows), str(dir_path)
+
+def test_mixed_channels_in_parallel(mixed_corpus):
+    desc_table, dir_path = mixed_corpus
+    serial = get_audio_data(desc_table, dir_path, frame_length=256)
+    parallel = get_audio_data(desc_table, dir_path, frame_length=256, num_workers=2)
+    assert {frame.data.shape[0] for frame in serial} == {1, 2}
+    assert len(parallel) == len(serial)
+    for parallel_frame, serial_frame in zip(parallel, serial):
+        assert torch.equal(parallel_frame.data, serial_frame.data)
+        assert parallel_frame.label_index == serial_frame.label_index
+
+def test_mixed_channels_columnar(mixed_corpus):
+    desc_table, dir_path = mixed_corpus
+    with pytest.raises(ValueError, match='channels'):
+        get_audio_data(desc_table, dir_path, frame_length=256, columnar=True)
@@ -0,0 +1,102 @@
+import numpy as np
+import pandas as pd
+import pytest
+import soundfile
+import torch
+
+from audio_datasets_wrappers.audio import pcm_to_float
+from audio_datasets_wrappers.dataset import LazyPhonemeDataset, PackedPhonemeDataset, PaddedCollate
+from audio_datasets_wrappers.extraction import get_audio_data, save_audio_data
+
+FRAME_RATE = 16000
+EXTRACTION_PARAMS = {
+    'framed': dict(overlapping_frames=True, frame_length=256),
+    'unframed': dict(overlapping_frames=False),
+    'padded': dict(overlapping_frames=True, padding_length=4000),
+    'parallel': dict(overlapping_frames=True, frame_length=256, num_workers=2, columnar=True)
+}
+
+
+def _write_corpus(dir_path, subtype: str = 'PCM_16', file_format: str = 'WAV', suffix: str = 'wav') -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    rows = list()
+    for i in range(4):
+        audio_file_path = f'speaker{i}.{suffix}'
+        samples = rng.integers(-2 ** 15, 2 ** 15, size=FRAME_RATE // 2, dtype=np.int16)
+        soundfile.write(dir_path / audio_file_path, samples, FRAME_RATE, subtype=subtype, format=file_format)
+        for j, (t0, t1) in enumerate([(0.0, 0.11), (0.11, 0.125), (0.2, 0.45)]):
+            rows.append(dict(
+                phone_name=f'p{j}',
+                phone_class=f'class{j}',
+                class_index=j,
+                audio_file_path=audio_file_path,
+                t0=t0,
+                t1=t1
+            ))
+    return pd.DataFrame(rows)
+
+@pytest.fixture(scope='module')
+def corpus(tmp_path_factory):
+    dir_path = tmp_path_factory.mktemp('corpus')
+    return _write_corpus(dir_path), str(dir_path)
+
+def _assert_round_trip(pcm_frames, float_frames) -> None:
+    assert len(pcm_frames) == len(float_frames)
+    for pcm_frame, float_frame in zip(pcm_frames, float_frames):
+        assert pcm_frame.data.dtype == torch.int16
+        assert pcm_frame.label_index == float_frame.label_index
+        assert torch.equal(pcm_to_float(pcm_frame.data), float_frame.data)
+
+
+@pytest.mark.parametrize('params', EXTRACTION_PARAMS.values(), ids=EXTRACTION_PARAMS.keys())
+def test_extraction_round_trip(corpus, params):
+    desc_table, dir_path = corpus
+    _assert_round_trip(
+        get_audio_data(desc_table, dir_path, int16=True, **params),
+        get_audio_data(desc_table, dir_path, **params)
+    )
+
+def test_packed_store_round_trip(corpus, tmp_path):
+    desc_table, dir_path = corpus
+    pcm_frames = get_audio_data(desc_table, dir_path, frame_length=256, columnar=True, int16=True)
+    save_audio_data(pcm_frames, tmp_path / 'frames')
+    dataset = PackedPhonemeDataset(tmp_path / 'frames')
+    assert dataset.samples.dtype == np.int16
+    float_frames = get_audio_data(desc_table, dir_path, frame_length=256)
+    assert len(dataset) == len(float_frames)
+    for i, float_frame in enumerate(float_frames):
+        data, label_index = dataset[i]
+        assert data.dtype == torch.int16
+        assert int(label_index) == float_frame.label_index
+        assert torch.equal(pcm_to_float(data), float_frame.data)
+
+def test_lazy_round_trip(corpus):
+    desc_table, dir_path = corpus
+    pcm_dataset = LazyPhonemeDataset(desc_table, dir_path, frame_length=256, int16=True)
+    float_dataset = LazyPhonemeDataset(desc_table, dir_path, frame_length=256)
+    assert len(pcm_dataset) == len(float_dataset)
+    for i in range(len(float_dataset)):
+        assert pcm_dataset[i][0].dtype == torch.int16
+        assert torch.equal(pcm_to_float(pcm_dataset[i][0]), float_dataset[i][0])
+
+def test_collate_round_trip(corpus):
+    desc_table, dir_path = corpus
+    params = EXTRACTION_PARAMS['unframed']
+    pcm_batch = PaddedCollate()([(frame.data, frame.label_index) for frame in get_audio_data(desc_table, dir_path, int16=True, **params)])
+    float_batch = PaddedCollate()([(frame.data, frame.label_index) for frame in get_audio_data(desc_table, dir_path, **params)])
+    assert pcm_batch[0].dtype == torch.int16
+    assert torch.equal(pcm_to_float(pcm_batch[0]), float_batch[0])
+    for pcm_column, float_column in zip(pcm_batch[1:], float_batch[1:]):
+        assert torch.equal(pcm_column, float_column)
+
+@pytest.mark.parametrize(
+    'subtype, file_format, suffix',
+    [('PCM_24', 'WAV', 'wav'), ('VORBIS', 'OGG', 'ogg')],
+    ids=['24-bit', 'compressed']
+)
+def test_rejects_inexact_formats(tmp_path, subtype, file_format, suffix):
+    desc_table = _write_corpus(tmp_path, subtype, file_format, suffix)
+    with pytest.raises(ValueError, match='int16'):
+        get_audio_data(desc_table, str(tmp_path), int16=True)
+    with pytest.raises(ValueError, match='int16'):
+        LazyPhonemeDataset(desc_table, str(tmp_path), int16=True)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import torch
+
+from audio_datasets_wrappers.dataset import PhonemeFrames
+from audio_datasets_wrappers.shards import ShardedPhonemeDataset, save_shards
+
+
+@pytest.fixture(scope='module')
+def shards_dir(tmp_path_factory):
+    # frames of unequal lengths give shards of unequal frame counts, every frame holds its own position
+    lengths = [3, 5, 2, 8, 4, 6, 1] * 4
+    segments = [torch.full((1, 1, 16 * length), float(i)) for i, length in enumerate(lengths)]
+    frames = PhonemeFrames.from_segments(segments, np.zeros(len(segments)), {0: 'class0'}, np.tile([16000, 16], (len(segments), 1)))
+    dir_path = tmp_path_factory.mktemp('shards')
+    save_shards(frames, str(dir_path), max_shard_size=1024)
+    return str(dir_path)
+
+@pytest.mark.parametrize('world_size', [2, 3, 7])
+def test_ranks_get_equal_frames_without_dropping_any(shards_dir, world_size):
+    rank_frames = list()
+    for rank in range(world_size):
+        dataset = ShardedPhonemeDataset(shards_dir, shuffle=True, seed=0)
+        dataset.rank_info = (rank, world_size)
+        rank_frames.append([int(data[0, 0]) for data, _ in dataset])
+    assert len({len(frames) for frames in rank_frames}) == 1
+    assert set().union(*rank_frames) == set(range(28))
+
+def test_rejects_more_ranks_than_shards(shards_dir, monkeypatch):
+    monkeypatch.setattr('audio_datasets_wrappers.shards.get_rank_info', lambda: (0, 9))
+    with pytest.raises(ValueError, match='shards'):
+        ShardedPhonemeDataset(shards_dir)